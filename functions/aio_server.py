@@ -0,0 +1,276 @@
+"""asyncio HTTP server with the same API as `main.py` (`POST /` and `POST /batch`, see README).
+
+Requests are read and parsed on the event loop. Decoding the images runs on a pool of `DECODE_THREADS` threads, and
+inference on the micro-batcher and inference engine of `main.py`, so the event loop never blocks on either. At most
+`MAX_PENDING_IMAGES` images are decoded or inferred at a time, further requests wait. When a client disconnects, its
+images that aren't being inferred yet are dropped.
+
+Usage (from the `functions` directory):
+    python aio_server.py --port 8080
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from PIL import Image
+
+import main
+
+executor_key = web.AppKey("executor", ThreadPoolExecutor)
+pending_key = web.AppKey("pending", asyncio.Semaphore)
+
+
+def side_to_move_of(request: web.Request, default=None) -> str:
+    """Side to move from the query parameter `side` or the header `X-Side-To-Move` (default `w`)."""
+    side_to_move = (
+        request.query.get("side")
+        or request.headers.get("X-Side-To-Move")
+        or default
+        or "w"
+    )
+    return normalized_side(side_to_move)
+
+
+def normalized_side(side_to_move) -> str:
+    side_to_move = str(side_to_move).lower()
+    return side_to_move if side_to_move in ["w", "b"] else "w"
+
+
+async def read_multipart(request: web.Request):
+    """The text fields (name -> value) and the files (list of `(name, file)`) of a multipart upload."""
+    fields, files = {}, []
+    async for part in await request.multipart():
+        if part.filename is None:
+            fields[part.name] = await part.text()
+        else:
+            files.append((part.name, io.BytesIO(await part.read())))
+    return fields, files
+
+
+async def read_image(request: web.Request):
+    """`(image file or data URL, side to move)` of a request to `POST /`. Raises `ValueError` if it is malformed."""
+    if request.content_type.startswith("image/"):
+        return io.BytesIO(await request.read()), side_to_move_of(request)
+
+    if request.content_type == "multipart/form-data":
+        fields, files = await read_multipart(request)
+        files = dict(files)
+        if "image" not in files:
+            raise ValueError("No image file provided")
+        return files["image"], side_to_move_of(request, fields.get("side"))
+
+    if request.content_type == "application/json":
+        try:
+            request_json = await request.json()
+        except ValueError:
+            raise ValueError("Invalid JSON")
+        if not isinstance(request_json, dict) or "image" not in request_json:
+            raise ValueError("No image data provided")
+        return request_json["image"], normalized_side(request_json.get("side", "w"))
+
+    raise ValueError("Request must be JSON, an image, or a multipart upload")
+
+
+async def read_batch(request: web.Request) -> list:
+    """`(id, image file or data URL, side to move)` of each image of a request to `POST /batch`. Raises
+    `ValueError` if it is malformed."""
+    if request.content_type == "multipart/form-data":
+        fields, files = await read_multipart(request)
+        default_side = side_to_move_of(request, fields.get("side"))
+        return [
+            (
+                image_id,
+                file,
+                normalized_side(fields.get(f"side.{image_id}", default_side)),
+            )
+            for image_id, file in files
+        ]
+
+    if request.content_type == "application/json":
+        try:
+            request_json = await request.json()
+        except ValueError:
+            raise ValueError("Invalid JSON")
+        if not isinstance(request_json, dict) or not isinstance(
+            request_json.get("images"), list
+        ):
+            raise ValueError('JSON must contain a list "images"')
+        default_side = side_to_move_of(request, request_json.get("side"))
+        images = []
+        for i, entry in enumerate(request_json["images"]):
+            if not isinstance(entry, dict) or "image" not in entry:
+                raise ValueError(f"Image {i} has no image data")
+            side_to_move = normalized_side(entry.get("side", default_side))
+            images.append((str(entry.get("id", i)), entry["image"], side_to_move))
+        return images
+
+    raise ValueError("Request must be JSON or a multipart upload")
+
+
+def open_and_submit(image_file):
+    """Runs on the decode threads: decodes the image and submits it for inference, or takes it from the cache."""
+    if not hasattr(image_file, "read"):
+        image_file = main.image_from_data_url(image_file)
+    return main.submit_fen_result(Image.open(image_file))
+
+
+def cancel_inference(job: asyncio.Future):
+    if not job.cancelled() and job.exception() is None:
+        job.result().cancel()
+
+
+async def get_fen_result(request: web.Request, image_file):
+    """The FenResult of `image_file`. If the request is cancelled, the image is dropped unless its inference has
+    already started."""
+    async with request.app[pending_key]:
+        loop = asyncio.get_running_loop()
+        job = asyncio.ensure_future(
+            loop.run_in_executor(request.app[executor_key], open_and_submit, image_file)
+        )
+        try:
+            future = await asyncio.shield(job)
+        except asyncio.CancelledError:
+            # The image is still being decoded, its inference is cancelled as soon as it is submitted
+            job.add_done_callback(cancel_inference)
+            raise
+
+        # Cancelling this also cancels the inference future, which the micro-batcher then skips
+        return await asyncio.wrap_future(future)
+
+
+@web.middleware
+async def record_metrics(request: web.Request, handler):
+    """Records the latency and the status of the responses to `POST /` and `POST /batch` in the metrics of `main`."""
+    path = request.path.rstrip("/")
+    if path == "/metrics":
+        return await handler(request)
+
+    start = time.perf_counter()
+    response = await handler(request)
+    endpoint = "batch" if path == "/batch" else "image"
+    main.record_response(endpoint, response.status, time.perf_counter() - start)
+    return response
+
+
+async def metrics(request: web.Request) -> web.Response:
+    if not main.METRICS:
+        return web.json_response({"error": "Metrics are disabled"}, status=404)
+    return web.Response(
+        body=main.metrics_text(),
+        headers={"Content-Type": main.prometheus_client.CONTENT_TYPE_LATEST},
+    )
+
+
+async def process_chess_image(request: web.Request) -> web.Response:
+    """Same contract as `main.process_chess_image`, without the per-request timings and profiles."""
+    try:
+        image_file, side_to_move = await read_image(request)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    try:
+        result = await get_fen_result(request, image_file)
+        return web.json_response(
+            {"fen": main.fen_with_side_to_move(result, side_to_move)}
+        )
+    except ValueError as e:
+        # Invalid data URLs are only noticed on the decode threads
+        return web.json_response({"error": str(e)}, status=400)
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+async def fen_line(request: web.Request, image_id, image_file, side_to_move) -> dict:
+    try:
+        result = await get_fen_result(request, image_file)
+        return {"id": image_id, "fen": main.fen_with_side_to_move(result, side_to_move)}
+    except Exception as e:
+        return {"id": image_id, "error": str(e)}
+
+
+async def process_chess_images(request: web.Request) -> web.StreamResponse:
+    """Same contract as `main.process_chess_images`: one NDJSON line per image, in the order they are finished."""
+    try:
+        images = await read_batch(request)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    if len(images) == 0:
+        return web.json_response({"error": "No images provided"}, status=400)
+    if len(images) > main.BATCH_MAX_IMAGES:
+        return web.json_response(
+            {"error": f"At most {main.BATCH_MAX_IMAGES} images per request"}, status=413
+        )
+
+    tasks = [asyncio.ensure_future(fen_line(request, *image)) for image in images]
+    try:
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for task in asyncio.as_completed(tasks):
+            await response.write((json.dumps(await task) + "\n").encode())
+        await response.write_eof()
+        return response
+    finally:
+        # Nothing is left to cancel unless the client disconnected
+        for task in tasks:
+            task.cancel()
+
+
+def create_app(
+    decode_threads=None, max_pending_images=64, max_request_mb=32
+) -> web.Application:
+    app = web.Application(
+        client_max_size=int(max_request_mb * 2**20), middlewares=[record_metrics]
+    )
+    app[executor_key] = ThreadPoolExecutor(decode_threads, thread_name_prefix="decode")
+    app[pending_key] = asyncio.Semaphore(max_pending_images)
+    app.router.add_post("/", process_chess_image)
+    app.router.add_post("/batch", process_chess_images)
+    app.router.add_get("/metrics", metrics)
+
+    async def shutdown_executor(app):
+        app[executor_key].shutdown(wait=False, cancel_futures=True)
+
+    app.on_cleanup.append(shutdown_executor)
+    return app
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Serves the API of main.py with an asyncio server"
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument(
+        "--decode_threads",
+        type=int,
+        default=int(os.getenv("DECODE_THREADS", "4")),
+        help="threads that decode images (default: DECODE_THREADS or 4)",
+    )
+    parser.add_argument(
+        "--max_pending_images",
+        type=int,
+        default=int(os.getenv("MAX_PENDING_IMAGES", "64")),
+        help="images that are decoded or inferred at the same time (default: MAX_PENDING_IMAGES or 64)",
+    )
+    parser.add_argument(
+        "--max_request_mb",
+        type=float,
+        default=float(os.getenv("MAX_REQUEST_MB", "32")),
+        help="maximum size of a request body (default: MAX_REQUEST_MB or 32)",
+    )
+    args = parser.parse_args()
+
+    main.engine.warm_up()
+    web.run_app(
+        create_app(args.decode_threads, args.max_pending_images, args.max_request_mb),
+        host=args.host,
+        port=args.port,
+        # Handlers of requests whose client disconnected are cancelled
+        handler_cancellation=True,
+    )
@@ -0,0 +1,33 @@
+"""Helpers that are shared by the benchmarks and `quantize_models.py`."""
+
+import os
+import resource
+import chess
+
+# Options of `get_fen` with which all benchmarks run the pipeline, the same as the server
+FEN_OPTIONS = dict(num_tries=10, auto_rotate_image=True, auto_rotate_board=True)
+
+
+def peak_rss_mb():
+    # On Linux, ru_maxrss keeps the peak of the parent process across exec, VmHWM doesn't
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def square_accuracy(fen, reference_fen):
+    if fen is None or reference_fen is None:
+        return float(fen == reference_fen)
+    board = chess.Board(fen).piece_map()
+    reference = chess.Board(reference_fen).piece_map()
+    return (
+        sum(board.get(square) == reference.get(square) for square in chess.SQUARES) / 64
+    )
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
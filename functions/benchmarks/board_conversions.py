@@ -0,0 +1,167 @@
+"""Micro-benchmark of the board <-> tensor conversions in `src/common.py`.
+
+Compares the table-driven implementations against the previous nested-loop implementations and checks
+that both give the same results.
+
+Usage (from the `functions` directory):
+    python -m benchmarks.board_conversions
+"""
+
+import argparse
+import random
+import timeit
+import chess
+import torch
+
+from src import common
+
+
+def loop_chess_board_to_tensor(board: chess.Board):
+    result = torch.zeros(64, len(common.PIECE_TYPES))
+
+    for square in chess.SQUARES:
+        sq_idx = common.square_to_idx(square)
+        for i, piece in enumerate(common.PIECE_TYPES):
+            if piece is None:
+                result[sq_idx, i] = 1.0
+            elif board.piece_at(square) == piece:
+                result[sq_idx, i] = 1.0
+                break
+
+    return result
+
+
+def loop_tensor_to_chess_board(tensor: torch.Tensor):
+    board = chess.Board(None)
+
+    for square in chess.SQUARES:
+        index = tensor[common.square_to_idx(square)].argmax().item()
+        if common.PIECE_TYPES[index] is not None:
+            board.set_piece_at(square, common.PIECE_TYPES[index])
+
+    return board
+
+
+def loop_flip_color(tensor: torch.Tensor):
+    flipped = torch.zeros_like(tensor)
+
+    for square in chess.SQUARES:
+        sq_idx = common.square_to_idx(square)
+        for i, piece in enumerate(common.PIECE_TYPES):
+            if piece is None:
+                flipped[sq_idx, i] = tensor[sq_idx, i]
+            else:
+                other_piece_i = common.PIECE_TYPES.index(
+                    chess.Piece(
+                        piece.piece_type,
+                        chess.BLACK if piece.color == chess.WHITE else chess.WHITE,
+                    )
+                )
+                flipped[sq_idx, other_piece_i] = tensor[sq_idx, i]
+    return flipped
+
+
+def loop_rotate_board_tensor(tensor: torch.Tensor):
+    mirrored = torch.zeros_like(tensor)
+
+    for square in chess.SQUARES:
+        sq_idx = common.square_to_idx(square)
+        for i in range(0, len(common.PIECE_TYPES)):
+            mirrored_sq_idx = 7 - (sq_idx % 8) + (7 - (sq_idx // 8)) * 8
+            mirrored[mirrored_sq_idx, i] = tensor[sq_idx, i]
+    return mirrored
+
+
+def random_board(num_pieces):
+    board = chess.Board(None)
+    for square in random.sample(chess.SQUARES, num_pieces):
+        board.set_piece_at(square, random.choice(common.PIECE_TYPES[:-1]))
+    return board
+
+
+def check_equal(boards, tensors):
+    for board, tensor in zip(boards, tensors):
+        assert torch.equal(
+            loop_chess_board_to_tensor(board), common.chess_board_to_tensor(board)
+        )
+        assert loop_tensor_to_chess_board(tensor) == common.tensor_to_chess_board(
+            tensor
+        )
+        assert loop_tensor_to_chess_board(tensor).fen() == common.tensor_to_fen(tensor)
+        assert torch.equal(loop_flip_color(tensor), common.flip_color(tensor))
+        assert torch.equal(
+            loop_rotate_board_tensor(tensor), common.rotate_board_tensor(tensor)
+        )
+
+
+def bench(name, loop_fn, table_fn, args, batched_fn=None, batched_args=None, number=10):
+    loop_time = timeit.timeit(lambda: [loop_fn(a) for a in args], number=number)
+    table_time = timeit.timeit(lambda: [table_fn(a) for a in args], number=number)
+    line = f"{name:<24} loop: {loop_time / number * 1000:9.3f} ms   table: {table_time / number * 1000:9.3f} ms   speedup: {loop_time / table_time:7.1f}x"
+    if batched_fn is not None:
+        batched_time = timeit.timeit(lambda: batched_fn(batched_args), number=number)
+        line += f"   batched: {batched_time / number * 1000:9.3f} ms   speedup: {loop_time / batched_time:7.1f}x"
+    print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the board <-> tensor conversions"
+    )
+    parser.add_argument("--num_boards", type=int, default=100)
+    parser.add_argument("--number", type=int, default=10, help="repetitions")
+    args = parser.parse_args()
+
+    random.seed(0)
+    torch.manual_seed(0)
+
+    boards = [random_board(random.randint(2, 32)) for _ in range(args.num_boards)]
+    tensors = torch.rand(args.num_boards, 64, len(common.PIECE_TYPES))
+
+    check_equal(boards, tensors)
+
+    print(f"{args.num_boards} boards, average over {args.number} repetitions")
+    bench(
+        "chess_board_to_tensor",
+        loop_chess_board_to_tensor,
+        common.chess_board_to_tensor,
+        boards,
+        common.chess_board_to_tensor,
+        boards,
+        number=args.number,
+    )
+    bench(
+        "tensor_to_chess_board",
+        loop_tensor_to_chess_board,
+        common.tensor_to_chess_board,
+        tensors,
+        number=args.number,
+    )
+    bench(
+        "tensor -> FEN",
+        lambda t: loop_tensor_to_chess_board(t).fen(),
+        common.tensor_to_fen,
+        tensors,
+        common.tensor_to_fen,
+        tensors,
+        number=args.number,
+    )
+    bench(
+        "flip_color",
+        loop_flip_color,
+        common.flip_color,
+        tensors,
+        common.flip_color,
+        tensors,
+        number=args.number,
+    )
+    bench(
+        "rotate_board_tensor",
+        loop_rotate_board_tensor,
+        common.rotate_board_tensor,
+        tensors,
+        common.rotate_board_tensor,
+        tensors,
+        number=args.number,
+    )
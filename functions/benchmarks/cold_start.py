@@ -0,0 +1,142 @@
+"""Measures the cold start of the models, i.e. the time from a fresh process to the first prediction.
+
+Every measurement runs in a new Python process, so that nothing is cached in memory. Two ways of loading the models
+are compared:
+    - `legacy`: the model is built with the pretrained ImageNet weights of its backbone (which torchvision downloads
+    or reads from its cache), and the checkpoint is then read and copied into it.
+    - `fast`: `SomeModel.load`, which builds the model without initializing its weights and memory-maps the
+    checkpoint.
+
+Usage (from the `functions` directory):
+    python -m benchmarks.cold_start
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+MODELS = {
+    "chess_existence": [1, 3, 512, 512],
+    "bbox_model": [1, 3, 512, 512],
+    "image_rotation_model": [1, 3, 256, 256],
+    "fen_model": [1, 3, 256, 256],
+    "orientation_model": [1, 64, 13],
+}
+
+
+def load_legacy(some_model):
+    import torch
+    import chess_diagram_to_fen as c2f
+
+    model = some_model.model_class()
+    model.load_state_dict(torch.load(some_model.model_path, map_location="cpu"))
+    model.to(c2f.device)
+    model.eval()
+    return model
+
+
+def worker(mode, names):
+    """Loads the models `names` in this process and prints the timings as JSON."""
+    start = time.perf_counter()
+    import torch
+    import chess_diagram_to_fen as c2f
+
+    timings = {"import": time.perf_counter() - start}
+
+    for name in names:
+        some_model = getattr(c2f, name)
+        try:
+            start = time.perf_counter()
+            if mode == "legacy":
+                model = load_legacy(some_model)
+            else:
+                model = some_model.get()
+            loaded = time.perf_counter()
+
+            with torch.no_grad():
+                model(torch.rand(MODELS[name], device=c2f.device))
+            timings[name] = {
+                "load": loaded - start,
+                "first_forward": time.perf_counter() - loaded,
+            }
+        except Exception as e:
+            timings[name] = {"error": f"{type(e).__name__}: {e}"}
+
+    print(json.dumps(timings))
+
+
+def run(mode, names):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.cold_start", "--worker", mode]
+        + ["--models"]
+        + names,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["process"] = time.perf_counter() - start
+    return timings
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if len(values) > 0 else None
+
+
+def ms(value):
+    return "-" if value is None else f"{value * 1000:.0f} ms"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compare the cold start time of the legacy and the fast model loading"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--models", nargs="+", default=list(MODELS.keys()), choices=list(MODELS.keys())
+    )
+    parser.add_argument("--worker", choices=["legacy", "fast"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        worker(args.worker, args.models)
+        sys.exit(0)
+
+    results = {
+        mode: [run(mode, args.models) for _ in range(args.repeat)]
+        for mode in ["legacy", "fast"]
+    }
+
+    columns = [
+        ("legacy", "load"),
+        ("fast", "load"),
+        ("legacy", "first_forward"),
+        ("fast", "first_forward"),
+    ]
+    print(f"Median of {args.repeat} fresh processes")
+    print(f"{'':<22}" + "".join(f"{mode + ' ' + key:>22}" for mode, key in columns))
+    for name in args.models:
+        row = f"{name:<22}"
+        for mode, key in columns:
+            row += f"{ms(median([r[name][key] for r in results[mode] if key in r[name]])):>22}"
+        errors = {
+            r[name]["error"]
+            for mode in results
+            for r in results[mode]
+            if "error" in r[name]
+        }
+        print(row + ("   " + "; ".join(errors) if len(errors) > 0 else ""))
+
+    for key in ["import", "process"]:
+        print(
+            f"{key:<22}"
+            + "".join(
+                f"{ms(median([r[key] for r in results[mode]])):>22}"
+                for mode in ["legacy", "fast"]
+            )
+        )
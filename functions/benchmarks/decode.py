@@ -0,0 +1,123 @@
+"""Compares decoding the images at full resolution with decoding JPEGs at a reduced resolution (see `decode_image`).
+
+The decoding of each way runs in a new Python process, so that its peak memory can be measured. Optionally, the FENs
+of both ways are compared, with the random test-time augmentations seeded identically.
+
+Usage (from the `functions` directory):
+    python -m benchmarks.decode --dir ../puzzles/ --fens
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+
+
+def worker(min_size, files):
+    """Decodes `files` one after the other in this process and prints the timings and memory as JSON."""
+    from PIL import Image
+    import chess_diagram_to_fen as c2f
+    from benchmarks import peak_rss_mb
+
+    baseline = peak_rss_mb()
+    latencies, sizes = [], []
+    for f in files:
+        start = time.perf_counter()
+        img = c2f.decode_image(Image.open(f), min_size=min_size)
+        latencies.append(time.perf_counter() - start)
+        sizes.append(list(img.size))
+        del img
+
+    print(
+        json.dumps(
+            dict(latencies=latencies, sizes=sizes, peak_mb=peak_rss_mb() - baseline)
+        )
+    )
+
+
+def run(min_size, files):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.decode", "--worker", str(min_size)] + files,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare_fens(files, min_size):
+    import torch
+    from PIL import Image
+    import chess_diagram_to_fen as c2f
+    from benchmarks import FEN_OPTIONS, square_accuracy
+
+    fens = {}
+    for size in [0, min_size]:
+        fens[size] = []
+        for f in files:
+            random.seed(0)
+            torch.manual_seed(0)
+            result = c2f.get_fen(
+                c2f.decode_image(Image.open(f), min_size=size), **FEN_OPTIONS
+            )
+            fens[size].append(None if result is None else result.fen)
+
+    pairs = list(zip(fens[min_size], fens[0]))
+    same = sum(fen == reference for fen, reference in pairs) / len(pairs)
+    squares = sum(square_accuracy(fen, reference) for fen, reference in pairs)
+    squares /= len(pairs)
+    print(
+        f"same FEN as full resolution: {same * 100:.1f}%, same square: {squares * 100:.2f}%"
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compare the decode time and memory of full and reduced resolution decoding"
+    )
+    parser.add_argument("--dir", type=str, help="images to decode")
+    parser.add_argument(
+        "--min_size",
+        type=int,
+        default=1024,
+        help="shorter side of the reduced resolution decoding (see DECODE_MIN_SIZE)",
+    )
+    parser.add_argument(
+        "--fens",
+        action="store_true",
+        help="also compare the FENs, which needs the models",
+    )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("files", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        worker(args.worker, args.files)
+        sys.exit(0)
+
+    if args.dir is None:
+        parser.error("--dir is required")
+
+    from src import common
+
+    files = sorted(common.glob_all_image_files_recursively(args.dir))
+    print(f"{len(files)} images")
+
+    print(
+        f"{'':<16}{'total (ms)':>12}{'max (ms)':>10}{'peak (MB)':>11}{'mean size':>14}"
+    )
+    for name, min_size in [("full", 0), (f"min {args.min_size}", args.min_size)]:
+        result = run(min_size, files)
+        latencies = result["latencies"]
+        width = sum(size[0] for size in result["sizes"]) / len(files)
+        height = sum(size[1] for size in result["sizes"]) / len(files)
+        print(
+            f"{name:<16}{sum(latencies) * 1000:>12.1f}{max(latencies) * 1000:>10.1f}"
+            f"{result['peak_mb']:>11.1f}{f'{width:.0f}x{height:.0f}':>14}"
+        )
+
+    if args.fens:
+        compare_fens(files, args.min_size)
@@ -0,0 +1,288 @@
+"""Benchmark of the whole `get_fen_batch` pipeline, for regression checks before a deploy.
+
+For every combination of batch size, `num_tries` and number of threads, a new Python process runs the pipeline over
+the images of `--dir` and over synthetic boards rendered with `common.get_image`. It reports the time of each stage
+per image (see `src/instrumentation.py`), the throughput, the latency of the batches and the peak RSS. The random
+test-time augmentations are seeded, so repeated runs do the same work.
+
+The results can be written as JSON and compared against the JSON of an earlier run. The comparison exits with status
+1 if a metric got worse by more than `--tolerance`.
+
+Usage (from the `functions` directory):
+    python -m benchmarks.pipeline --dir ../puzzles/ --output baseline.json
+    python -m benchmarks.pipeline --dir ../puzzles/ --output new.json --baseline baseline.json
+"""
+
+import argparse
+import io
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+STAGES = ["decode", "preprocess", "existence", "bbox", "rotation", "fen", "orientation"]
+
+# Metrics that are compared against the baseline, and whether higher values are better
+COMPARED_METRICS = [
+    ("throughput", True),
+    ("latency_p50_ms", False),
+    ("latency_p90_ms", False),
+    ("peak_rss_mb", False),
+]
+
+
+def synthetic_images(num_images, size=512, seed=0) -> list:
+    """PNG files (as bytes) of `num_images` random positions, rendered like the training data."""
+    from src import common
+    from benchmarks.board_conversions import random_board
+
+    random.seed(seed)
+    files = []
+    for _ in range(num_images):
+        img = common.get_image(random_board(random.randint(2, 32)), size, size)
+        file = io.BytesIO()
+        img.convert("RGB").save(file, format="PNG")
+        files.append(file.getvalue())
+    return files
+
+
+def load_files(directory, num_synthetic) -> list:
+    from src import common
+
+    files = []
+    if directory is not None:
+        for f in sorted(common.glob_all_image_files_recursively(directory)):
+            with open(f, "rb") as image_file:
+                files.append(image_file.read())
+    if num_synthetic > 0:
+        try:
+            files += synthetic_images(num_synthetic)
+        except Exception as e:
+            print(f"WARNING: Could not render synthetic boards: {e}", file=sys.stderr)
+    return files
+
+
+def worker(configuration, directory, num_synthetic, repeat):
+    """Runs the pipeline with `configuration` in this process and prints the measurements as JSON."""
+    import torch
+    from PIL import Image
+    import chess_diagram_to_fen as c2f
+    from benchmarks import peak_rss_mb, percentile
+    from src import instrumentation
+
+    torch.set_num_threads(configuration["threads"])
+    files = load_files(directory, num_synthetic)
+    batch_size = configuration["batch_size"]
+    batches = [files[i : i + batch_size] for i in range(0, len(files), batch_size)]
+
+    def run(batch):
+        imgs = [Image.open(io.BytesIO(data)) for data in batch]
+        return c2f.get_fen_batch(imgs, num_tries=configuration["num_tries"])
+
+    # Loads the models and initializes everything that is only done once
+    run(batches[0])
+
+    stages = {name: 0.0 for name in STAGES}
+    latencies = []
+    start = time.perf_counter()
+    for r in range(repeat):
+        random.seed(r)
+        torch.manual_seed(r)
+        for batch in batches:
+            with instrumentation.collect() as timings:
+                batch_start = time.perf_counter()
+                run(batch)
+                latencies.append(time.perf_counter() - batch_start)
+            for name, seconds in timings.items():
+                stages[name] = stages.get(name, 0.0) + seconds
+    elapsed = time.perf_counter() - start
+
+    num_images = len(files) * repeat
+    print(
+        json.dumps(
+            dict(
+                configuration,
+                images=num_images,
+                throughput=num_images / elapsed,
+                latency_p50_ms=percentile(latencies, 50) * 1000,
+                latency_p90_ms=percentile(latencies, 90) * 1000,
+                peak_rss_mb=peak_rss_mb(),
+                stage_ms={
+                    name: seconds / num_images * 1000
+                    for name, seconds in stages.items()
+                },
+            )
+        )
+    )
+
+
+def run(configuration, args):
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.pipeline",
+        "--worker",
+        json.dumps(configuration),
+        "--num_synthetic",
+        str(args.num_synthetic),
+        "--repeat",
+        str(args.repeat),
+    ]
+    if args.dir is not None:
+        command += ["--dir", args.dir]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def environment() -> dict:
+    import torch
+    from chess_diagram_to_fen import available_cpus
+
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "cpus": available_cpus(),
+    }
+
+
+def configuration_name(result) -> str:
+    return f"batch {result['batch_size']}, tries {result['num_tries']}, threads {result['threads']}"
+
+
+def print_results(results):
+    print(
+        f"{'':<34}{'img/s':>8}{'p50 (ms)':>10}{'p90 (ms)':>10}{'RSS (MB)':>10}"
+        + "".join(f"{name:>12}" for name in STAGES)
+    )
+    for result in results:
+        print(
+            f"{configuration_name(result):<34}{result['throughput']:>8.2f}{result['latency_p50_ms']:>10.1f}"
+            f"{result['latency_p90_ms']:>10.1f}{result['peak_rss_mb']:>10.0f}"
+            + "".join(f"{result['stage_ms'].get(name, 0.0):>12.1f}" for name in STAGES)
+        )
+    print("Stages in ms per image")
+
+
+def compare(results, baseline, tolerance, min_stage_ms) -> list:
+    """Returns a description of every metric of `results` that is worse than in `baseline` by more than
+    `tolerance` (a fraction). Stages below `min_stage_ms` per image are too noisy to compare.
+    """
+    baseline_results = {
+        configuration_name(result): result for result in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        name = configuration_name(result)
+        if name not in baseline_results:
+            print(f"WARNING: {name} is not in the baseline")
+            continue
+        old = baseline_results[name]
+
+        metrics = [
+            (key, higher_is_better, old[key], result[key])
+            for key, higher_is_better in COMPARED_METRICS
+        ]
+        for stage in STAGES:
+            old_ms = old["stage_ms"].get(stage, 0.0)
+            new_ms = result["stage_ms"].get(stage, 0.0)
+            if max(old_ms, new_ms) >= min_stage_ms:
+                metrics.append((f"{stage} (ms)", False, old_ms, new_ms))
+
+        for key, higher_is_better, old_value, new_value in metrics:
+            if old_value == 0:
+                continue
+            change = (new_value - old_value) / old_value
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{name}: {key} {old_value:.2f} -> {new_value:.2f} ({change * 100:+.1f}%)"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of the pipeline and compare against a baseline"
+    )
+    parser.add_argument(
+        "--dir", type=str, default=None, help="images, e.g. ../puzzles/"
+    )
+    parser.add_argument(
+        "--num_synthetic", type=int, default=16, help="number of rendered random boards"
+    )
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--num_tries", type=int, nargs="+", default=[1, 10])
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=None, help="default: 1 and all CPUs"
+    )
+    parser.add_argument("--repeat", type=int, default=2, help="passes over all images")
+    parser.add_argument(
+        "--output", type=str, default=None, help="write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="JSON file of an earlier run to compare with",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative change that counts as a regression (default: 0.1)",
+    )
+    parser.add_argument(
+        "--min_stage_ms",
+        type=float,
+        default=1.0,
+        help="stages faster than this per image aren't compared (default: 1.0)",
+    )
+    parser.add_argument("--worker", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        worker(json.loads(args.worker), args.dir, args.num_synthetic, args.repeat)
+        sys.exit(0)
+
+    info = environment()
+    threads = args.threads or sorted({1, info["cpus"]})
+    results = []
+    for batch_size, num_tries, num_threads in itertools.product(
+        args.batch_sizes, args.num_tries, threads
+    ):
+        configuration = dict(
+            batch_size=batch_size, num_tries=num_tries, threads=num_threads
+        )
+        results.append(run(configuration, args))
+        print(
+            f"{configuration_name(results[-1])}: {results[-1]['throughput']:.2f} images/s"
+        )
+
+    print()
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"environment": info, "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Baseline: {baseline['environment']}")
+        regressions = compare(results, baseline, args.tolerance, args.min_stage_ms)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions:")
+            for regression in regressions:
+                print(f"    {regression}")
+            sys.exit(1)
+        print("No regressions")
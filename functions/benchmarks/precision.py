@@ -0,0 +1,77 @@
+"""Compares float32 NCHW inference against channels-last and bfloat16 autocast on a fixed set of images.
+
+For every configuration, reports the latency of `get_fen` and how many FENs and squares are the same as with
+float32 NCHW. The random test-time augmentations are seeded identically for all configurations.
+
+Usage (from the `functions` directory):
+    python -m benchmarks.precision --dir ../puzzles/
+"""
+
+import argparse
+import random
+import time
+import torch
+from PIL import Image
+
+import chess_diagram_to_fen as c2f
+from benchmarks import FEN_OPTIONS, percentile, square_accuracy
+from src import common, precision
+
+CONFIGURATIONS = {
+    "fp32 NCHW": dict(channels_last=False, bf16=False),
+    "fp32 channels-last": dict(channels_last=True, bf16=False),
+    "bf16 NCHW": dict(channels_last=False, bf16=True),
+    "bf16 channels-last": dict(channels_last=True, bf16=True),
+}
+
+
+def run(imgs, configuration):
+    c2f.use_precision(**configuration)
+    for some_model in c2f.all_models.values():
+        some_model.get()
+
+    random.seed(0)
+    torch.manual_seed(0)
+    fens, latencies = [], []
+    for img in imgs:
+        start = time.perf_counter()
+        result = c2f.get_fen(img, **FEN_OPTIONS)
+        latencies.append(time.perf_counter() - start)
+        fens.append(None if result is None else result.fen)
+    return fens, latencies
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compare latency and accuracy of channels-last and bfloat16 inference"
+    )
+    parser.add_argument("--dir", type=str, required=True, help="evaluation images")
+    args = parser.parse_args()
+
+    imgs = [
+        Image.open(f).convert("RGB")
+        for f in sorted(common.glob_all_image_files_recursively(args.dir))
+    ]
+    print(
+        f"{len(imgs)} images, native bfloat16: {precision.bf16_supported(c2f.device)}"
+    )
+
+    # Warm up, so that the first configuration doesn't pay for one-time initialization
+    run(imgs[:1], CONFIGURATIONS["fp32 NCHW"])
+
+    reference = None
+    print(
+        f"{'':<22}{'p50 (ms)':>10}{'p90 (ms)':>10}{'same FEN':>10}{'same square':>13}"
+    )
+    for name, configuration in CONFIGURATIONS.items():
+        fens, latencies = run(imgs, configuration)
+        if reference is None:
+            reference = fens
+        pairs = list(zip(fens, reference))
+        same = sum(fen == reference_fen for fen, reference_fen in pairs) / len(pairs)
+        squares = sum(square_accuracy(fen, ref) for fen, ref in pairs) / len(pairs)
+        print(
+            f"{name:<22}{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 90) * 1000:>10.1f}"
+            f"{same * 100:>9.1f}%{squares * 100:>12.2f}%"
+        )
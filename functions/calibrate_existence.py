@@ -0,0 +1,86 @@
+import argparse
+import torch
+from PIL import Image
+
+import chess_diagram_to_fen as c2f
+from src import common
+from src.bounding_box.inference import mask_statistics
+
+
+@torch.no_grad()
+def collect(files, batch_size):
+    """Returns the bbox mask statistics and the decision of the existence model for each file."""
+    areas, confidences, exists = [], [], []
+    for start in range(0, len(files), batch_size):
+        imgs = [Image.open(f).convert("RGB") for f in files[start : start + batch_size]]
+        inputs = [c2f.shared_inputs(img) for img in imgs]
+        existence_inputs = torch.stack([input[0] for input in inputs])
+        bbox_inputs = torch.stack([input[1] for input in inputs])
+
+        area, confidence = mask_statistics(c2f.predict_bbox_masks(bbox_inputs))
+        areas += area.tolist()
+        confidences += confidence.tolist()
+        exists += c2f.predict_existence(existence_inputs)
+
+    return areas, confidences, exists
+
+
+def calibrate(areas, confidences, exists, area_margin):
+    """For a range of confidence thresholds, finds the smallest area threshold for which no image that the existence
+    model rejects would be accepted. Returns `(min_confidence, min_area, skipped_fraction)` for each of them.
+    """
+    num_positives = max(sum(exists), 1)
+    rows = []
+    for min_confidence in [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99]:
+        negative_areas = [
+            area
+            for area, confidence, e in zip(areas, confidences, exists)
+            if not e and confidence >= min_confidence
+        ]
+        min_area = max(negative_areas + [0.0]) * area_margin
+        min_area = max(min_area, 0.01)
+        skipped = sum(
+            1
+            for area, confidence, e in zip(areas, confidences, exists)
+            if e and confidence >= min_confidence and area > min_area
+        )
+        rows.append((min_confidence, min_area, skipped / num_positives))
+    return rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Calibrates the thresholds used by get_fen(..., existence_from_bbox=True) against the existence model"
+    )
+    parser.add_argument(
+        "--dir",
+        type=str,
+        required=True,
+        help="directory that contains images with and without chess diagrams",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--area_margin",
+        type=float,
+        default=1.2,
+        help="safety factor on the largest area of a rejected image",
+    )
+    args = parser.parse_args()
+
+    files = common.glob_all_image_files_recursively(args.dir)
+    print(f"Found {len(files)} files")
+
+    areas, confidences, exists = collect(files, args.batch_size)
+    print(f"The existence model accepts {sum(exists)} of {len(exists)} images")
+
+    rows = calibrate(areas, confidences, exists, args.area_margin)
+    print("min_confidence  min_area  skipped existence checks")
+    for min_confidence, min_area, skipped in rows:
+        print(f"{min_confidence:14.2f}  {min_area:8.3f}  {skipped * 100:6.1f}%")
+
+    min_confidence, min_area, skipped = max(rows, key=lambda row: row[2])
+    print()
+    print("Suggested values for chess_diagram_to_fen.py:")
+    print(f"BBOX_EXISTENCE_MIN_AREA = {min_area:.3f}")
+    print(f"BBOX_EXISTENCE_MIN_CONFIDENCE = {min_confidence:.2f}")
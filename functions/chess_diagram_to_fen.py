@@ -4,7 +4,9 @@ import chess
 import argparse
 import random
 import os
+import threading
 from dataclasses import dataclass
+from contextlib import contextmanager
 from PIL import Image, ImageOps
 from pathlib import Path
 from src.bounding_box.model import ChessBoardBBox
@@ -15,41 +17,201 @@ from src.existence.model import ChessExistence
 import src.fen_recognition.dataset as fen_dataset
 import src.board_image_rotation.dataset as rotation_dataset
 
-from src.bounding_box.inference import get_bbox
-from src import consts, common
-
+from src.fen_cache import FenCache
+from src.bounding_box.inference import predict_masks, masks_to_bboxes, mask_statistics
+from src import (
+    consts,
+    common,
+    quantization,
+    onnx_backend,
+    compiled,
+    precision,
+    instrumentation,
+)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+WEIGHT_INIT_FUNCTIONS = [
+    "uniform_",
+    "normal_",
+    "trunc_normal_",
+    "constant_",
+    "ones_",
+    "zeros_",
+    "xavier_uniform_",
+    "xavier_normal_",
+    "kaiming_uniform_",
+    "kaiming_normal_",
+    "orthogonal_",
+]
+
+
+# torch.nn.init is shared by all threads, so only one thread may patch it at a time
+weight_init_lock = threading.Lock()
+
+
+@contextmanager
+def skip_weight_init():
+    """Turns the functions of `torch.nn.init` into no-ops, for building models whose weights are loaded anyway."""
+    with weight_init_lock:
+        originals = {
+            name: getattr(torch.nn.init, name) for name in WEIGHT_INIT_FUNCTIONS
+        }
+        try:
+            for name in WEIGHT_INIT_FUNCTIONS:
+                setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+            yield
+        finally:
+            for name, function in originals.items():
+                setattr(torch.nn.init, name, function)
+
+
 class SomeModel:
 
-    def __init__(self, model_class: type, default_path=None) -> None:
+    def __init__(
+        self, model_class: type, default_path=None, input_shape=None, **model_kwargs
+    ) -> None:
         self.model = None
         self.model_path = default_path
+        self.quantized_model_path = None
+        self.onnx_model_path = None
+        self.compiled = False
+        self.channels_last = False
+        self.bf16 = False
         self.model_class = model_class
+        self.input_shape = input_shape
+        self.model_kwargs = model_kwargs
+        self.lock = threading.Lock()
 
     def get(self):
-        if self.model is None:
-            if self.model_path is None:
-                raise Exception(
-                    "Model path not set. Use set_model_path to set the model path."
-                )
+        """Returns the model, in eval mode. It is built on the first call, and only once even if many threads call
+        this at the same time."""
+        model = self.model
+        if model is None:
+            with self.lock:
+                if self.model is None:
+                    with instrumentation.stage("load_" + self.model_class.__name__):
+                        self.model = self.build()
+                model = self.model
+        return model
+
+    def build(self):
+        """Loads the model with the configured backend and puts it into eval mode for good."""
+        if self.onnx_model_path is not None:
+            model = onnx_backend.OnnxModel(self.onnx_model_path)
+        elif self.quantized_model_path is not None:
+            model = self.load_quantized()
+        elif self.model_path is None:
+            raise Exception(
+                "Model path not set. Use set_model_path to set the model path."
+            )
+        else:
+            model = self.load()
+
+        if isinstance(model, torch.nn.Module):
+            model.eval()
+            model.requires_grad_(False)
 
-            self.model = self.model_class()
-            self.model.load_state_dict(
-                torch.load(
-                    self.model_path,
-                    map_location=torch.device("cpu"),
+        if self.channels_last or self.bf16:
+            if (
+                self.onnx_model_path is not None
+                or self.quantized_model_path is not None
+                or self.compiled
+            ):
+                print(
+                    "WARNING: Channels-last and bfloat16 are only used for eager full precision models"
+                )
+            else:
+                model = precision.MixedPrecisionModel(
+                    model, device, self.channels_last, self.bf16
                 )
+
+        if self.compiled and self.onnx_model_path is None:
+            model = compiled.CompiledModel(
+                model, self.input_shape, self.checkpoint_path(), device
+            )
+            # Now instead of on the first call, so that the workers of a server share the graph of the parent
+            model.graph()
+        return model
+
+    def load(self):
+        """Builds the model and loads the checkpoint.
+
+        The weights are not randomly initialized while the model is built, and the shapes of the lazy layers are
+        taken from the checkpoint. The checkpoint is memory-mapped and its tensors are used as the parameters of the
+        model, without an additional copy on the CPU.
+        """
+        with skip_weight_init():
+            model = self.model_class(**self.model_kwargs)
+
+        state_dict = torch.load(
+            self.model_path, map_location=device, mmap=True, weights_only=True
+        )
+        model.load_state_dict(state_dict, assign=True)
+        return model
+
+    def load_quantized(self):
+        """Builds the INT8 model (see `src/quantization.py`) and loads the quantized checkpoint."""
+        if device.type != "cpu":
+            raise Exception("Quantized models can only run on the CPU.")
+
+        with skip_weight_init():
+            model = self.model_class(**self.model_kwargs)
+        quantization.build(model, torch.zeros(self.input_shape))
+
+        model.load_state_dict(
+            torch.load(
+                self.quantized_model_path,
+                map_location=torch.device("cpu"),
+                weights_only=True,
             )
-            self.model.to(device)
-        self.model.eval()
-        return self.model
+        )
+        return model
 
     def set_model_path(self, model_path: str):
-        self.model = None
-        self.model_path = model_path
+        with self.lock:
+            self.model = None
+            self.model_path = model_path
+
+    def set_quantized_model_path(self, quantized_model_path):
+        """Uses the INT8 checkpoint `quantized_model_path` (created by `quantize_models.py`) instead of the model
+        path, or the full precision model again if it is `None`."""
+        with self.lock:
+            self.model = None
+            self.quantized_model_path = quantized_model_path
+
+    def set_onnx_model_path(self, onnx_model_path):
+        """Runs the ONNX file `onnx_model_path` (created by `export_onnx.py`) with ONNX Runtime instead of the PyTorch
+        model, or the PyTorch model again if it is `None`."""
+        with self.lock:
+            self.model = None
+            self.onnx_model_path = onnx_model_path
+
+    def set_compiled(self, compiled: bool):
+        """Runs the model as frozen TorchScript graphs (see `src/compiled.py`) if `compiled`, otherwise eagerly."""
+        with self.lock:
+            self.model = None
+            self.compiled = compiled
+
+    def set_precision(self, channels_last=False, bf16=False):
+        """Runs the model with channels-last memory format and/or bfloat16 autocast (see `src/precision.py`). Use
+        `use_precision`, which checks whether the device supports bfloat16 natively."""
+        with self.lock:
+            self.model = None
+            self.channels_last = channels_last
+            self.bf16 = bf16
+
+    def set_model_kwargs(self, **model_kwargs):
+        """Updates the keyword arguments the model class is built with, e.g. inference options that aren't part of
+        the checkpoint."""
+        with self.lock:
+            self.model = None
+            self.model_kwargs = dict(self.model_kwargs, **model_kwargs)
+
+    def checkpoint_path(self):
+        """The file the model is loaded from."""
+        return self.onnx_model_path or self.quantized_model_path or self.model_path
 
 
 script_dir = os.path.abspath(os.path.dirname(__file__))
@@ -57,118 +219,513 @@ script_dir = os.path.abspath(os.path.dirname(__file__))
 chess_existence = SomeModel(
     ChessExistence,
     script_dir + "/models/best_model_existence_0.998_2024-04-16-23-44-48.pth",
+    input_shape=[1, 3, consts.BBOX_IMAGE_SIZE, consts.BBOX_IMAGE_SIZE],
+    pretrained=False,
 )
 bbox_model = SomeModel(
     ChessBoardBBox,
     script_dir + "/models/best_model_bbox_0.958_2024-01-28-22-49-40.pth",
+    input_shape=[1, 3, consts.BBOX_IMAGE_SIZE, consts.BBOX_IMAGE_SIZE],
+    pretrained=False,
 )
 image_rotation_model = SomeModel(
     ImageRotation,
     script_dir + "/models/best_model_image_rotation_0.996_2024-04-14-22-59-55.pth",
+    input_shape=[1, 3, consts.BOARD_PIXEL_WIDTH, consts.BOARD_PIXEL_WIDTH],
+    pretrained=False,
 )
 fen_model = SomeModel(
     ChessRec,
     script_dir + "/models/best_model_fen_0.943_2024-04-19-09-31-24.pth",
+    input_shape=[1, 3, consts.BOARD_PIXEL_WIDTH, consts.BOARD_PIXEL_WIDTH],
+    pretrained=False,
 )
 orientation_model = SomeModel(
     OrientationModel,
     script_dir + "/models/best_model_orientation_0.987_2024-02-04-17-34-05.pth",
+    input_shape=[1, 64, len(common.PIECE_TYPES)],
 )
 
+all_models = {
+    "chess_existence": chess_existence,
+    "bbox_model": bbox_model,
+    "image_rotation_model": image_rotation_model,
+    "fen_model": fen_model,
+    "orientation_model": orientation_model,
+}
+
+
+def quantized_checkpoint_path(model_path: str) -> str:
+    """Where `quantize_models.py` stores the INT8 version of the checkpoint `model_path` by default."""
+    return os.path.splitext(model_path)[0] + "_int8.pth"
+
+
+def onnx_checkpoint_path(model_path: str) -> str:
+    """Where `export_onnx.py` stores the ONNX version of the checkpoint `model_path` by default."""
+    return os.path.splitext(model_path)[0] + ".onnx"
+
+
+def check_model_names(names: list):
+    for name in names:
+        if name not in all_models:
+            raise Exception(f"Unknown model {name}, expected one of {list(all_models)}")
+
+
+def use_quantized_models(names: list):
+    """Uses the INT8 checkpoints (see `quantize_models.py`) for the models `names`, e.g. `["fen_model"]`, and the
+    full precision checkpoints for all other models."""
+    check_model_names(names)
+    for name, some_model in all_models.items():
+        some_model.set_quantized_model_path(
+            quantized_checkpoint_path(some_model.model_path) if name in names else None
+        )
+
+
+def use_onnx_models(names: list):
+    """Runs the models `names` with ONNX Runtime (see `export_onnx.py`), e.g. `["fen_model"]`, and all other models
+    with PyTorch."""
+    check_model_names(names)
+    for name, some_model in all_models.items():
+        some_model.set_onnx_model_path(
+            onnx_checkpoint_path(some_model.model_path) if name in names else None
+        )
+
+
+def use_compiled_models(names: list):
+    """Runs the models `names` as compiled graphs (see `compile_models.py`), e.g. `["fen_model"]`, and all other
+    models eagerly."""
+    check_model_names(names)
+    for name, some_model in all_models.items():
+        some_model.set_compiled(name in names)
+
+
+def use_precision(channels_last=False, bf16=False):
+    """Runs all models with channels-last memory format and/or bfloat16 autocast, see `SomeModel.set_precision`."""
+    if bf16 and not precision.bf16_supported(device):
+        print(
+            f"WARNING: {device} doesn't support bfloat16 natively, using float32 instead"
+        )
+        bf16 = False
+    for some_model in all_models.values():
+        some_model.set_precision(channels_last, bf16)
+
+
+def use_tile_deduplication(deduplicate=True, cache_size=0):
+    """Runs the tile encoder of the FEN model only once for identical squares, and keeps the embeddings of up to
+    `cache_size` squares across calls, see `ChessRec.encode_tiles`. This only applies when the FEN model runs eagerly
+    with PyTorch (also when quantized), not with ONNX Runtime or as compiled graphs."""
+    fen_model.set_model_kwargs(
+        deduplicate_tiles=deduplicate, tile_cache_size=cache_size
+    )
+
+
+def model_checkpoints() -> list:
+    """File names of the checkpoints that are used, so that results of other checkpoints aren't taken from a cache."""
+    return [
+        os.path.basename(some_model.checkpoint_path() or "")
+        for some_model in all_models.values()
+    ]
+
+
+# Maximum number of samples that are passed through a model in one forward call
+MAX_BATCH_SIZE = 32
+
+
+def forward_in_chunks(model, input: torch.Tensor, max_batch_size=MAX_BATCH_SIZE):
+    return torch.cat([model(chunk) for chunk in input.split(max_batch_size)])
+
+
+# JPEGs are decoded at 1/2, 1/4 or 1/8 of their resolution as long as the shorter side stays at least this long.
+# The existence and bbox models only look at BBOX_IMAGE_SIZE, so this leaves enough room for zooming in.
+DECODE_MIN_SIZE = 1024
+
+
+def decode_image(img: Image.Image, min_size=DECODE_MIN_SIZE) -> Image.Image:
+    """Decodes `img` and converts it to RGB.
+
+    If `img` is a JPEG that isn't decoded yet, libjpeg scales it down while decoding (see `Image.draft`), which is
+    much faster and needs much less memory than decoding the full resolution. The result then remembers where it was
+    decoded from, so that `crop_full_resolution` can decode a small region again at a higher resolution.
+
+    Args:
+        - `img (PIL.Image.Image)`: The image, e.g. as returned by `Image.open`.
+        - `min_size (int)`: The minimum length of the shorter side of the decoded image. `0` disables the reduced
+        resolution decoding.
+
+    Returns:
+        - `PIL.Image.Image`: The decoded RGB image. If `img` is already decoded and RGB, it is returned as is.
+    """
+    if img.mode == "RGB" and not getattr(img, "tile", None):
+        return img
+
+    if min_size <= 0 or img.format != "JPEG" or len(img.tile) == 0:
+        return img.convert("RGB")
+
+    full_size = img.size
+    source = img.filename if getattr(img, "filename", "") else img.fp
+    scale = min_size / min(full_size)
+    img.draft("RGB", (int(full_size[0] * scale), int(full_size[1] * scale)))
+    decoded = img.convert("RGB")
+
+    if decoded.size != full_size:
+        decoded.info["draft_source"] = source
+        decoded.info["draft_full_size"] = full_size
+    return decoded
+
+
+def crop_padded(img: Image.Image, box) -> Image.Image:
+    """Crops `img` to `box`, which may reach beyond the image. That part is white, like the padding of `common.pad`."""
+    x1, y1, x2, y2 = box
+    result = Image.new("RGB", (x2 - x1, y2 - y1), "white")
+    inside = (max(x1, 0), max(y1, 0), min(x2, img.width), min(y2, img.height))
+    if inside[2] > inside[0] and inside[3] > inside[1]:
+        result.paste(img.crop(inside), (inside[0] - x1, inside[1] - y1))
+    return result
+
+
+def crop_full_resolution(img: Image.Image, box, min_crop_size=consts.BOARD_PIXEL_WIDTH):
+    """Decodes the source of `img`, which was decoded at a reduced resolution by `decode_image`, again at the lowest
+    resolution at which `box` (in the coordinates of `img`) is at least `min_crop_size` wide and high, and returns
+    that region. Returns `None` if `img` wasn't decoded at a reduced resolution."""
+    source = img.info.get("draft_source")
+    if source is None:
+        return None
+
+    x1, y1, x2, y2 = box
+    factor = min_crop_size / max(min(x2 - x1, y2 - y1), 1)
+    full = decode_image(Image.open(source), min_size=int(min(img.size) * factor) + 1)
+    x_factor = full.width / img.width
+    y_factor = full.height / img.height
+    return crop_padded(
+        full,
+        (
+            round(x1 * x_factor),
+            round(y1 * y_factor),
+            round(x2 * x_factor),
+            round(y2 * y_factor),
+        ),
+    )
+
+
+def rgb_tensor(img) -> torch.Tensor:
+    # Images that already were converted by common.to_rgb_tensor are used as they are
+    if isinstance(img, torch.Tensor) and img.is_floating_point():
+        return img
+    return common.to_rgb_tensor(img)
+
+
+def existence_input(img) -> torch.Tensor:
+    img_tensor = rgb_tensor(img)
+    img_tensor = functional.resize(
+        img_tensor, [consts.BBOX_IMAGE_SIZE, consts.BBOX_IMAGE_SIZE]
+    )
+    img_tensor = img_tensor.to(device)
+    return common.MinMaxMeanNormalization()(img_tensor)
+
 
 @torch.no_grad()
+def predict_existence(input: torch.Tensor, max_batch_size=MAX_BATCH_SIZE) -> list:
+    if len(input) == 0:
+        return []
+
+    output = forward_in_chunks(chess_existence.get(), input.to(device), max_batch_size)
+
+    return [value > 0.5 for value in output.squeeze(1).cpu().tolist()]
+
+
+def check_for_chess_existence_batch(imgs: list, max_batch_size=MAX_BATCH_SIZE) -> list:
+    if len(imgs) == 0:
+        return []
+
+    input = torch.stack([existence_input(img) for img in imgs])
+    return predict_existence(input, max_batch_size=max_batch_size)
+
+
 def check_for_chess_existence(img: Image.Image) -> bool:
+    return check_for_chess_existence_batch([img])[0]
 
-    img_tensor = common.to_rgb_tensor(img)
+
+BBOX_PAD_FACTOR = 0.05
+
+
+def bbox_input(img) -> torch.Tensor:
+    img_tensor = rgb_tensor(img)
     img_tensor = functional.resize(
         img_tensor, [consts.BBOX_IMAGE_SIZE, consts.BBOX_IMAGE_SIZE]
     )
-    img_tensor = img_tensor.to(device)
-    img_tensor = common.MinMaxMeanNormalization()(img_tensor)
+    return common.MinMaxMeanNormalization()(img_tensor)
+
+
+def padded_bbox_input(img) -> torch.Tensor:
+    """The same as `bbox_input(common.pad(img, ...))` with the padding of the first iteration of
+    `crop_to_chessboard_batch`, but the white padding is added to the RGB tensor instead of the PIL image.
+    """
+    img_tensor = rgb_tensor(img)
+    pad_x = int(img_tensor.shape[2] * BBOX_PAD_FACTOR)
+    pad_y = int(img_tensor.shape[1] * BBOX_PAD_FACTOR)
+    img_tensor = torch.nn.functional.pad(
+        img_tensor, (pad_x, pad_x, pad_y, pad_y), value=1.0
+    )
+    return bbox_input(img_tensor)
+
 
-    output = chess_existence.get()(img_tensor.unsqueeze(0)).squeeze(0)
+def shared_inputs(img: Image.Image):
+    """Returns the input of the existence model and the input of the first bbox iteration for `img`.
 
-    return output.cpu().item() > 0.5
+    Both are computed from the same full resolution RGB tensor, which is only created once.
+    """
+    img_tensor = common.to_rgb_tensor(img)
+    return existence_input(img_tensor), padded_bbox_input(img_tensor)
 
 
 @torch.no_grad()
-def crop_to_chessboard(img: Image.Image, max_num_tries=10) -> Image.Image:
+def predict_bbox_masks(input: torch.Tensor, max_batch_size=MAX_BATCH_SIZE):
+    return torch.cat(
+        [
+            predict_masks(bbox_model.get(), chunk)
+            for chunk in input.split(max_batch_size)
+        ]
+    )
 
-    pad_factor = 0.05
-    pad_x = img.width * pad_factor
-    pad_y = img.height * pad_factor
 
-    img = common.pad(img, pad_x, pad_y)
+# If the bbox model finds a region of at least this fraction of the image with at least this mean probability,
+# a chessboard is assumed to exist without asking the existence model.
+# Calibrate them against the existence model with `python calibrate_existence.py`.
+BBOX_EXISTENCE_MIN_AREA = 0.05
+BBOX_EXISTENCE_MIN_CONFIDENCE = 0.9
 
-    for _ in range(0, max_num_tries):
-        if img.width == 0 or img.height == 0:
-            return None
 
-        img_tensor = common.to_rgb_tensor(img)
-        img_tensor = functional.resize(
-            img_tensor, [consts.BBOX_IMAGE_SIZE, consts.BBOX_IMAGE_SIZE]
-        )
-        img_tensor = common.MinMaxMeanNormalization()(img_tensor)
+def existence_from_masks(
+    masks: torch.Tensor, existence_inputs: torch.Tensor, max_batch_size=MAX_BATCH_SIZE
+) -> list:
+    """Decides from the bbox masks of the first crop iteration if there is a chessboard in each image.
+    Only the images for which the masks are not convincing go through the existence model.
+    """
+    area, confidence = mask_statistics(masks)
+    exists = (
+        (area >= BBOX_EXISTENCE_MIN_AREA)
+        & (confidence >= BBOX_EXISTENCE_MIN_CONFIDENCE)
+    ).tolist()
+
+    unsure = [i for i in range(len(exists)) if not exists[i]]
+    for i, exists_i in zip(
+        unsure,
+        predict_existence(existence_inputs[unsure], max_batch_size=max_batch_size),
+    ):
+        exists[i] = exists_i
+
+    return exists
+
+
+def scale_bbox(img: Image.Image, bbox: torch.Tensor):
+    """Scales the `bbox` predicted on the resized `img` back to `img` and returns it as integer coordinates."""
+
+    x1, y1, x2, y2 = bbox
+    x_factor = img.width / consts.BBOX_IMAGE_SIZE
+    y_factor = img.height / consts.BBOX_IMAGE_SIZE
+    x1 *= x_factor
+    x2 *= x_factor
+    y1 *= y_factor
+    y2 *= y_factor
+
+    x1 = int(x1.clamp(0, img.width - 1))
+    x2 = int(x2.clamp(0, img.width - 1))
+    y1 = int(y1.clamp(0, img.height - 1))
+    y2 = int(y2.clamp(0, img.height - 1))
+
+    return x1, y1, x2, y2
+
+
+def bbox_ratio(img: Image.Image, box) -> float:
+    x1, y1, x2, y2 = box
+    return min((x2 - x1) / img.width, (y2 - y1) / img.height)
+
+
+def zoom_box(img: Image.Image, box, margin):
+    """`box` enlarged on each side by `margin` times its size, as integer coordinates within `img`."""
+    x1, y1, x2, y2 = box
+
+    x_addition = (x2 - x1) * margin
+    y_addition = (y2 - y1) * margin
+    x1 = max(x1 - x_addition, 0)
+    x2 = min(x2 + x_addition, img.width)
+    y1 = max(y1 - y_addition, 0)
+    y2 = min(y2 + y_addition, img.height)
+
+    # Image.crop rounds the same way
+    return round(x1), round(y1), round(x2), round(y2)
+
+
+def move_box(box, offset):
+    x, y = offset
+    x1, y1, x2, y2 = box
+    return x1 + x, y1 + y, x2 + x, y2 + y
+
+
+def zoom_crop(img: Image.Image, box, margin) -> Image.Image:
+    """Crops `img` to `box`, enlarged on each side by `margin` times its size."""
+    return img.crop(zoom_box(img, box, margin))
+
+
+@torch.no_grad()
+def crop_to_chessboard_batch(
+    imgs: list,
+    max_num_tries=10,
+    max_batch_size=MAX_BATCH_SIZE,
+    first_inputs: torch.Tensor = None,
+    first_masks: torch.Tensor = None,
+    zoom_margins=(0.1,),
+    return_boxes=False,
+):
+    """Returns a list with the image cropped to the chessboard, or `None`, for each image, and a list with the
+    number of bbox iterations that were used for each image. If `return_boxes` is `True`, there is a third list with
+    the box `(x1, y1, x2, y2)` of each crop in the coordinates of the image, which may reach into the padding.
+
+    Each iteration runs the bbox model once over all images that still need it. We only accept a bounding box if it
+    is relatively big compared to the entire image. Otherwise the next iteration looks at the image cropped closer to
+    the estimated true bbox. There is one candidate crop for each margin in `zoom_margins`, and all candidates are
+    evaluated in the same forward pass. After `max_num_tries` iterations the best bbox found so far is used.
 
-        bbox = get_bbox(bbox_model.get(), img_tensor)
-        if bbox is None:
-            return None
+    The inputs `[B, 3, BBOX_IMAGE_SIZE, BBOX_IMAGE_SIZE]` of the first iteration (see `padded_bbox_input`)
+    or even the bbox masks predicted for them can be passed if they are already known.
+    """
+
+    # Candidate crops of each image that are evaluated in the next iteration, with the position of their top left
+    # corner in the image
+    candidates = [
+        [
+            (
+                common.pad(
+                    img, img.width * BBOX_PAD_FACTOR, img.height * BBOX_PAD_FACTOR
+                ),
+                (-int(img.width * BBOX_PAD_FACTOR), -int(img.height * BBOX_PAD_FACTOR)),
+            )
+        ]
+        for img in imgs
+    ]
+    results = [None] * len(imgs)
+    boxes = [None] * len(imgs)
+    num_iterations = [0] * len(imgs)
+
+    # Indices of the images for which we are still searching the bbox
+    searching = list(range(len(imgs)))
+
+    for iteration in range(0, max_num_tries):
+        for i in searching:
+            candidates[i] = [
+                (candidate, offset)
+                for candidate, offset in candidates[i]
+                if candidate.width > 0 and candidate.height > 0
+            ]
+        searching = [i for i in searching if len(candidates[i]) > 0]
+        if len(searching) == 0:
+            break
+
+        entries = [(i, candidate) for i in searching for candidate in candidates[i]]
+        if iteration == 0 and first_masks is not None:
+            masks = first_masks[searching]
+        else:
+            with instrumentation.annotation(f"bbox_iteration_{iteration}"):
+                if iteration == 0 and first_inputs is not None:
+                    input = first_inputs[searching]
+                else:
+                    input = torch.stack(
+                        [bbox_input(candidate) for _, (candidate, _) in entries]
+                    )
+                masks = predict_bbox_masks(input, max_batch_size=max_batch_size)
+
+        evaluated = {i: [] for i in searching}
+        for (i, (candidate, offset)), bbox in zip(entries, masks_to_bboxes(masks)):
+            if bbox is not None:
+                box = scale_bbox(candidate, bbox)
+                evaluated[i].append(
+                    (candidate, offset, box, bbox_ratio(candidate, box))
+                )
 
-        x1, y1, x2, y2 = bbox
-        x_factor = img.width / consts.BBOX_IMAGE_SIZE
-        y_factor = img.height / consts.BBOX_IMAGE_SIZE
-        x1 *= x_factor
-        x2 *= x_factor
-        y1 *= y_factor
-        y2 *= y_factor
+        still_searching = []
+        for i in searching:
+            num_iterations[i] = iteration + 1
+            if len(evaluated[i]) == 0:
+                continue
+
+            accepted = [entry for entry in evaluated[i] if entry[3] > 0.7]
+            if len(accepted) > 0:
+                candidate, offset, box, _ = accepted[0]
+                results[i] = candidate.crop(box)
+                boxes[i] = move_box(box, offset)
+                continue
 
-        x1 = int(x1.clamp(0, img.width - 1))
-        x2 = int(x2.clamp(0, img.width - 1))
-        y1 = int(y1.clamp(0, img.height - 1))
-        y2 = int(y2.clamp(0, img.height - 1))
+            candidate, offset, box, _ = max(evaluated[i], key=lambda entry: entry[3])
+            if iteration == max_num_tries - 1:
+                # No more iterations left, so we take the best bbox we have
+                if box[2] > box[0] and box[3] > box[1]:
+                    results[i] = candidate.crop(box)
+                    boxes[i] = move_box(box, offset)
+                continue
 
-        new_width = x2 - x1
-        new_height = y2 - y1
+            candidates[i] = []
+            for margin in zoom_margins:
+                zoomed = zoom_box(candidate, box, margin)
+                candidates[i].append(
+                    (candidate.crop(zoomed), move_box(zoomed, offset)[:2])
+                )
+            still_searching.append(i)
 
-        # We only accept the bounding box if it is relatively big compared to the entire image.
-        # Otherwise we try again by cropping the image a little closer to the estimated true bbox
-        if new_width / img.width > 0.7 and new_height / img.height > 0.7:
-            return img.crop((x1, y1, x2, y2))
+        searching = still_searching
 
-        x_addition = new_width * 0.1
-        y_addition = new_height * 0.1
-        x1 = max(x1 - x_addition, 0)
-        x2 = min(x2 + x_addition, img.width)
-        y1 = max(y1 - y_addition, 0)
-        y2 = min(y2 + y_addition, img.height)
+    if return_boxes:
+        return results, num_iterations, boxes
+    return results, num_iterations
 
-        img = img.crop((x1, y1, x2, y2))
 
-    return None
+def crop_to_chessboard(img: Image.Image, max_num_tries=10) -> Image.Image:
+    return crop_to_chessboard_batch([img], max_num_tries=max_num_tries)[0][0]
 
 
 @torch.no_grad()
+def board_image_rotation_batch(imgs: list, max_batch_size=MAX_BATCH_SIZE) -> list:
+    if len(imgs) == 0:
+        return []
+
+    input = torch.stack(
+        [rotation_dataset.default_transforms(common.to_rgb_tensor(img)) for img in imgs]
+    ).to(device)
+    output = forward_in_chunks(image_rotation_model.get(), input, max_batch_size)
+
+    return output.argmax(dim=1).cpu().tolist()
+
+
 def board_image_rotation(img: Image.Image) -> int:
-    input_img = common.to_rgb_tensor(img)
-    input_img = rotation_dataset.default_transforms(input_img).to(device)
-    pred = (
-        image_rotation_model.get()(input_img.unsqueeze(0))
-        .cpu()
-        .squeeze(0)
-        .argmax()
-        .item()
-    )
-    return pred
+    return board_image_rotation_batch([img])[0]
 
 
 @torch.no_grad()
-def is_board_flipped(board: chess.Board, no_rotate_bias=0.2) -> bool:
-    board_tensor = common.chess_board_to_tensor(board)
-    output = (
-        orientation_model.get()(board_tensor.unsqueeze(0).to(device)).squeeze(0).cpu()
+def is_board_flipped_batch(
+    boards: list, no_rotate_bias=0.2, max_batch_size=MAX_BATCH_SIZE
+) -> list:
+    """`boards` can contain `chess.Board`s as well as board tensors `[64, 13]`."""
+    if len(boards) == 0:
+        return []
+
+    input = torch.stack(
+        [
+            (
+                board
+                if isinstance(board, torch.Tensor)
+                else common.chess_board_to_tensor(board)
+            )
+            for board in boards
+        ]
     )
+    output = forward_in_chunks(
+        orientation_model.get(), input.to(device), max_batch_size
+    )
+
+    return [value - no_rotate_bias > 0.5 for value in output.squeeze(1).cpu().tolist()]
+
 
-    return output.item() - no_rotate_bias > 0.5
+def is_board_flipped(board: chess.Board, no_rotate_bias=0.2) -> bool:
+    return is_board_flipped_batch([board], no_rotate_bias=no_rotate_bias)[0]
 
 
 @torch.no_grad()
@@ -178,44 +735,177 @@ def rotate_board(board: chess.Board) -> chess.Board:
     return common.tensor_to_chess_board(board_tensor)
 
 
+def get_tta_inputs(img: torch.Tensor, num_tries, first_try=0) -> torch.Tensor:
+    """Builds the `num_tries` test-time augmented inputs for the FEN model as one batch of shape
+    `[num_tries, 3, BOARD_PIXEL_WIDTH, BOARD_PIXEL_WIDTH]`, starting with try number `first_try`.
+
+    The first two tries are not augmented and every odd try is color flipped. The random augmentations
+    are drawn in the same order as in the sequential loop, so a fixed seed gives the same inputs.
+    """
+    inputs = []
+    while len(inputs) < num_tries:
+        input = img
+        try_index = first_try + len(inputs)
+
+        if try_index >= 2:
+            with instrumentation.annotation("tta_augment"):
+                input = fen_dataset.augment_transforms(input)
+
+        if try_index % 2 == 1:
+            input = -input
+
+        input = fen_dataset.default_transforms(input)
+
+        if input.isnan().any():
+            print("WARNING: Found nan after transforms.")
+            continue
+
+        inputs.append(input)
+
+    return torch.stack(inputs)
+
+
+@torch.no_grad()
+def get_board_tensors_from_cropped_imgs(
+    imgs: list,
+    num_tries=20,
+    max_batch_size=MAX_BATCH_SIZE,
+    adaptive_tries=False,
+    stable_tries=2,
+    min_margin=0.5,
+    tries_per_round=2,
+):
+    """Returns a list with the one-hot board tensor `[64, 13]` for each image, or `None` if the image is too small or
+    no piece was found, and a list with the number of tries that were used for each image.
+
+    If `adaptive_tries` is `True`, the tries run in rounds of `tries_per_round`. An image stops early once the most
+    likely piece on each square hasn't changed for the last `stable_tries` tries and, on every square, the average
+    score of the most likely piece is at least `min_margin` higher than that of the second most likely one.
+    Hard images still use all `num_tries` tries.
+    """
+    MIN_SIZE = 32
+    results = [None] * len(imgs)
+    num_tries_used = [0] * len(imgs)
+    indices = [
+        i
+        for i, img in enumerate(imgs)
+        if img.width >= MIN_SIZE and img.height >= MIN_SIZE
+    ]
+    if len(indices) == 0:
+        return results, num_tries_used
+
+    rgb_imgs = [common.to_rgb_tensor(imgs[i]).to(device) for i in indices]
+    sums = torch.zeros(len(indices), 64, len(common.PIECE_TYPES))
+    last_argmax = [None] * len(indices)
+    stable = [0] * len(indices)
+
+    # Positions in indices of the images that still need more tries
+    active = list(range(len(indices)))
+    tries = 0
+    while len(active) > 0 and tries < num_tries:
+        round_tries = num_tries - tries
+        if adaptive_tries:
+            round_tries = min(tries_per_round, round_tries)
+
+        # The tries of all images go through the FEN model together
+        input = torch.cat(
+            [get_tta_inputs(rgb_imgs[j], round_tries, first_try=tries) for j in active]
+        )
+        outputs = forward_in_chunks(fen_model.get(), input, max_batch_size).clamp(0, 1)
+        outputs = outputs.reshape(len(active), round_tries, 64, len(common.PIECE_TYPES))
+        color_flipped = torch.tensor(
+            [t % 2 == 1 for t in range(tries, tries + round_tries)]
+        )
+        outputs[:, color_flipped] = common.flip_color(outputs[:, color_flipped])
+        sums[active] += outputs.sum(dim=1).cpu()
+        tries += round_tries
+
+        for j in active:
+            num_tries_used[indices[j]] = tries
+
+        if adaptive_tries:
+            mean = sums[active] / tries
+            argmax = mean.argmax(dim=-1)
+            top2 = mean.topk(2, dim=-1).values
+            confident = (top2[..., 0] - top2[..., 1] >= min_margin).all(dim=-1)
+
+            still_active = []
+            for k, j in enumerate(active):
+                if last_argmax[j] is not None and torch.equal(
+                    last_argmax[j], argmax[k]
+                ):
+                    stable[j] += round_tries
+                else:
+                    stable[j] = 0
+                last_argmax[j] = argmax[k]
+
+                if stable[j] < stable_tries or not confident[k]:
+                    still_active.append(j)
+            active = still_active
+
+    board_tensors = common.to_one_hot(sums)
+
+    for i, board_tensor in zip(indices, board_tensors):
+        if not board_tensor[:, common.EMPTY_INDEX].all():
+            results[i] = board_tensor
+
+    return results, num_tries_used
+
+
+def get_boards_from_cropped_imgs(
+    imgs: list, num_tries=20, max_batch_size=MAX_BATCH_SIZE
+) -> list:
+    return [
+        common.tensor_to_chess_board(board_tensor) if board_tensor is not None else None
+        for board_tensor in get_board_tensors_from_cropped_imgs(
+            imgs, num_tries=num_tries, max_batch_size=max_batch_size
+        )[0]
+    ]
+
+
 @torch.no_grad()
-def get_board_from_cropped_img(img: Image.Image, num_tries=20) -> chess.Board:
+def get_board_from_cropped_img(
+    img: Image.Image, num_tries=20, batch_tries=True
+) -> chess.Board:
+    if batch_tries:
+        # All tries in one forward pass of the FEN model
+        return get_boards_from_cropped_imgs([img], num_tries=num_tries)[0]
+
     MIN_SIZE = 32
     if img.width < MIN_SIZE or img.height < MIN_SIZE:
         return None
 
     img = common.to_rgb_tensor(img).to(device)
     sum = None
-    with torch.no_grad():
-        tries = 0
-        while tries < num_tries:
-            input = img
+    tries = 0
+    while tries < num_tries:
+        input = img
 
-            if tries >= 2:
-                input = fen_dataset.augment_transforms(input)
+        if tries >= 2:
+            input = fen_dataset.augment_transforms(input)
 
-            color_flipped = tries % 2 == 1
-            if color_flipped:
-                input = -input
+        color_flipped = tries % 2 == 1
+        if color_flipped:
+            input = -input
 
-            input = fen_dataset.default_transforms(input)
+        input = fen_dataset.default_transforms(input)
 
-            if input.isnan().any():
-                print("WARNING: Found nan after transforms.")
-                continue
+        if input.isnan().any():
+            print("WARNING: Found nan after transforms.")
+            continue
 
-            output = fen_model.get()(input.unsqueeze(0)).squeeze(0)
-            output = output.clamp(0, 1)
-            # print(output)
+        output = fen_model.get()(input.unsqueeze(0)).squeeze(0)
+        output = output.clamp(0, 1)
+        # print(output)
 
-            if color_flipped:
-                output = common.flip_color(output)
+        if color_flipped:
+            output = common.flip_color(output)
 
-            if sum is None:
-                sum = output
-            else:
-                sum += output
-            tries += 1
+        if sum is None:
+            sum = output
+        else:
+            sum += output
+        tries += 1
 
     board = common.tensor_to_chess_board(sum.cpu())
     if board.occupied == 0:
@@ -229,6 +919,223 @@ class FenResult:
     cropped_image: Image = None
     image_rotation_angle: int = None
     board_is_flipped: bool = None
+    num_tries_used: int = None
+    num_bbox_iterations: int = None
+    # Seconds spent in each stage by the batch this result was inferred in, if a server collected them
+    timings: dict = None
+
+
+def fen_result_to_dict(result: FenResult):
+    """JSON-serializable version of `result` for a `FenCache`, without the cropped image and the timings."""
+    if result is None:
+        return None
+    result = dict(vars(result))
+    del result["cropped_image"]
+    del result["timings"]
+    return result
+
+
+def fen_result_from_dict(value) -> FenResult:
+    if value is None:
+        return None
+    return FenResult(**value)
+
+
+def cache_key(
+    img: Image.Image,
+    num_tries=10,
+    auto_rotate_image=True,
+    mirror_when_180_rotation=False,
+    auto_rotate_board=True,
+    adaptive_tries=False,
+    existence_from_bbox=False,
+    max_bbox_iterations=2,
+    zoom_margins=(0.1,),
+) -> str:
+    """The key of the result of `get_fen(img, ...)` in a `FenCache`. `img` must already be converted to RGB."""
+    return FenCache.key(
+        img,
+        dict(
+            num_tries=num_tries,
+            auto_rotate_image=auto_rotate_image,
+            mirror_when_180_rotation=mirror_when_180_rotation,
+            auto_rotate_board=auto_rotate_board,
+            adaptive_tries=adaptive_tries,
+            existence_from_bbox=existence_from_bbox,
+            max_bbox_iterations=max_bbox_iterations,
+            zoom_margins=list(zoom_margins),
+            checkpoints=model_checkpoints(),
+            bf16=any(some_model.bf16 for some_model in all_models.values()),
+        ),
+    )
+
+
+def get_fen_batch(
+    imgs: list,
+    num_tries=10,
+    auto_rotate_image=True,
+    mirror_when_180_rotation=False,
+    auto_rotate_board=True,
+    adaptive_tries=False,
+    existence_from_bbox=False,
+    max_bbox_iterations=2,
+    zoom_margins=(0.1,),
+    max_batch_size=MAX_BATCH_SIZE,
+    cache: FenCache = None,
+):
+    """Like `get_fen`, but for many images at once.
+
+    Every stage of the pipeline runs as one batch over all images that survived the previous stages,
+    which is much faster than calling `get_fen` for each image.
+
+    Args:
+        - `imgs (list[PIL.Image.Image])`: The images of chess diagrams. JPEGs that aren't decoded yet are decoded at a
+        reduced resolution, see `decode_image`.
+        - `max_bbox_iterations (int)`: The maximum number of bbox model passes per image to find the chessboard. If the board is
+        small compared to the image, the second pass looks at the image zoomed to the board found in the first one.
+        - `zoom_margins (tuple[float])`: The margins around the board found in the previous pass for the zoomed candidate crops.
+        More margins give more robust crops of small boards, at the cost of a bigger batch in the second pass.
+        - `max_batch_size (int)`: The maximum number of samples that are passed through a model at once.
+        Larger batches are faster but need more memory.
+        - `cache (FenCache)`: If this is set, results are looked up in and stored to this cache. Cached results
+        don't contain the `cropped_image`.
+        - See `get_fen` for the other arguments.
+
+    Returns:
+        - `list[FenResult | None]`: One entry for each image in `imgs`, in the same order. An entry is `None`
+        if there is no chessboard detectable in the corresponding image.
+    """
+
+    if len(imgs) == 0:
+        return []
+
+    with instrumentation.stage("decode"):
+        imgs = [decode_image(img) for img in imgs]
+    results = [None] * len(imgs)
+
+    options = dict(
+        num_tries=num_tries,
+        auto_rotate_image=auto_rotate_image,
+        mirror_when_180_rotation=mirror_when_180_rotation,
+        auto_rotate_board=auto_rotate_board,
+        adaptive_tries=adaptive_tries,
+        existence_from_bbox=existence_from_bbox,
+        max_bbox_iterations=max_bbox_iterations,
+        zoom_margins=zoom_margins,
+    )
+
+    if cache is not None:
+        keys = [cache_key(img, **options) for img in imgs]
+        missing = []
+        for i, key in enumerate(keys):
+            found, value = cache.get(key)
+            if found:
+                results[i] = fen_result_from_dict(value)
+            else:
+                missing.append(i)
+
+        # The images are decoded already, so `decode_image` passes them through without another copy
+        computed = get_fen_batch(
+            [imgs[i] for i in missing], max_batch_size=max_batch_size, **options
+        )
+        for i, result in zip(missing, computed):
+            cache.put(keys[i], fen_result_to_dict(result))
+            results[i] = result
+
+        return results
+
+    with instrumentation.stage("preprocess"):
+        # The existence check and the first bbox iteration share the RGB conversion of each image
+        inputs = [shared_inputs(img) for img in imgs]
+        existence_inputs = torch.stack([input[0] for input in inputs])
+        bbox_inputs = torch.stack([input[1] for input in inputs])
+
+    first_masks = None
+    if existence_from_bbox:
+        with instrumentation.stage("bbox"):
+            first_masks = predict_bbox_masks(bbox_inputs, max_batch_size=max_batch_size)
+
+    with instrumentation.stage("existence"):
+        if first_masks is not None:
+            exists = existence_from_masks(
+                first_masks, existence_inputs, max_batch_size=max_batch_size
+            )
+        else:
+            exists = predict_existence(existence_inputs, max_batch_size=max_batch_size)
+
+    indices = [i for i in range(len(imgs)) if exists[i]]
+    for i in indices:
+        results[i] = FenResult()
+
+    with instrumentation.stage("bbox"):
+        cropped_images, num_bbox_iterations, boxes = crop_to_chessboard_batch(
+            [imgs[i] for i in indices],
+            max_num_tries=max_bbox_iterations,
+            max_batch_size=max_batch_size,
+            first_inputs=bbox_inputs[indices],
+            first_masks=first_masks[indices] if first_masks is not None else None,
+            zoom_margins=zoom_margins,
+            return_boxes=True,
+        )
+        for i, cropped_image, iterations, box in zip(
+            indices, cropped_images, num_bbox_iterations, boxes
+        ):
+            # A board that is small in an image decoded at a reduced resolution is decoded again at a higher one
+            if (
+                cropped_image is not None
+                and min(cropped_image.size) < consts.BOARD_PIXEL_WIDTH
+                and "draft_source" in imgs[i].info
+            ):
+                cropped_image = crop_full_resolution(imgs[i], box)
+            results[i].cropped_image = cropped_image
+            results[i].num_bbox_iterations = iterations
+    indices = [i for i in indices if results[i].cropped_image is not None]
+
+    with instrumentation.stage("rotation"):
+        rotations = board_image_rotation_batch(
+            [results[i].cropped_image for i in indices], max_batch_size=max_batch_size
+        )
+        for i, rotation in zip(indices, rotations):
+            result = results[i]
+            result.image_rotation_angle = rotation
+
+            if auto_rotate_image:
+
+                result.cropped_image = result.cropped_image.rotate(
+                    -rotation_dataset.ROTATIONS[result.image_rotation_angle],
+                    expand=True,
+                )
+
+                if (
+                    mirror_when_180_rotation
+                    and rotation_dataset.ROTATIONS[result.image_rotation_angle] == 180
+                ):
+                    result.cropped_image = ImageOps.mirror(result.cropped_image)
+
+    with instrumentation.stage("fen"):
+        # The boards stay tensors until the final FEN string is built
+        board_tensors, num_tries_used = get_board_tensors_from_cropped_imgs(
+            [results[i].cropped_image for i in indices],
+            num_tries=num_tries,
+            max_batch_size=max_batch_size,
+            adaptive_tries=adaptive_tries,
+        )
+        for i, tries in zip(indices, num_tries_used):
+            results[i].num_tries_used = tries
+        indices = [i for i, board in zip(indices, board_tensors) if board is not None]
+        board_tensors = [board for board in board_tensors if board is not None]
+
+    with instrumentation.stage("orientation"):
+        flipped = is_board_flipped_batch(board_tensors, max_batch_size=max_batch_size)
+        for i, board_tensor, board_is_flipped in zip(indices, board_tensors, flipped):
+            results[i].board_is_flipped = board_is_flipped
+
+            if auto_rotate_board and board_is_flipped:
+                board_tensor = common.rotate_board_tensor(board_tensor)
+
+            results[i].fen = common.tensor_to_fen(board_tensor)
+
+    return results
 
 
 def get_fen(
@@ -237,6 +1144,9 @@ def get_fen(
     auto_rotate_image=True,
     mirror_when_180_rotation=False,
     auto_rotate_board=True,
+    adaptive_tries=False,
+    existence_from_bbox=False,
+    cache: FenCache = None,
 ):
     """Takes an image and returns an FEN (Forsyth-Edwards Notation) string.
 
@@ -249,46 +1159,99 @@ def get_fen(
         (left to right) if it was rotated 180°.
         - `auto_rotate_board (bool)`: If this is set to `True`, this function will try to guess if the diagram is from whites or blacks
         perspective and rotate the board accordingly.
+        - `adaptive_tries (bool)`: If this is set to `True`, `num_tries` is only the maximum number of tries. This function will stop
+        early once the prediction is stable and confident on every square, which is much faster for clean digital diagrams.
+        - `existence_from_bbox (bool)`: If this is set to `True`, the bounding box model runs first and the existence model is skipped
+        when the bounding box model has clearly found a chessboard.
+        - `cache (FenCache)`: If this is set, the result is looked up in and stored to this cache. Cached results don't contain
+        the `cropped_image`.
 
     Returns:
-        - `FenResult | None`: Returns a dataclass that contains the fields `fen`, `cropped_image`, `image_rotation_angle`, and `board_is_flipped`.
+        - `FenResult | None`: Returns a dataclass that contains the fields `fen`, `cropped_image`, `image_rotation_angle`, `board_is_flipped`,
+        `num_tries_used`, and `num_bbox_iterations`.
         Returns `None` if there is no chessboard detectable.
     """
 
-    img = img.convert("RGB")
-
-    if not check_for_chess_existence(img):
-        return None
+    return get_fen_batch(
+        [img],
+        num_tries=num_tries,
+        auto_rotate_image=auto_rotate_image,
+        mirror_when_180_rotation=mirror_when_180_rotation,
+        auto_rotate_board=auto_rotate_board,
+        adaptive_tries=adaptive_tries,
+        existence_from_bbox=existence_from_bbox,
+        cache=cache,
+    )[0]
 
-    result = FenResult()
-    result.cropped_image = crop_to_chessboard(img, max_num_tries=num_tries)
-    if result.cropped_image is not None:
-        result.image_rotation_angle = board_image_rotation(result.cropped_image)
 
-        if auto_rotate_image:
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
-            result.cropped_image = result.cropped_image.rotate(
-                -rotation_dataset.ROTATIONS[result.image_rotation_angle], expand=True
-            )
 
-            if (
-                mirror_when_180_rotation
-                and rotation_dataset.ROTATIONS[result.image_rotation_angle] == 180
-            ):
-                result.cropped_image = ImageOps.mirror(result.cropped_image)
+class InferenceEngine:
+    """Runs the pipeline for callers on many threads, without oversubscribing the CPU.
 
-        board = get_board_from_cropped_img(result.cropped_image, num_tries=num_tries)
+    At most `num_slots` batches are inferred at the same time, further callers wait for a free slot. Every batch
+    uses up to `num_threads` threads for its operators, so `num_slots * num_threads` should not exceed the number of
+    cores. The models are loaded once (see `warm_up`) and stay in eval mode, and inference runs without autograd.
 
-        if board is not None:
+    Args:
+        - `num_threads (int)`: Intra-op threads of PyTorch, by default the number of CPUs divided by `num_slots`.
+        - `num_interop_threads (int)`: Inter-op threads of PyTorch, by default PyTorch's choice. This can only be set
+        before PyTorch runs anything in parallel.
+        - `num_slots (int)`: How many batches may be inferred concurrently.
+        - `fen_options`: Keyword arguments for `get_fen_batch`, e.g. `num_tries=10`.
+    """
 
-            result.board_is_flipped = is_board_flipped(board)
+    def __init__(
+        self, num_threads=None, num_interop_threads=None, num_slots=1, **fen_options
+    ) -> None:
+        self.models = all_models
+        self.num_slots = num_slots
+        self.slots = threading.BoundedSemaphore(num_slots)
+        self.fen_options = fen_options
+
+        if num_threads is None:
+            num_threads = max(1, available_cpus() // num_slots)
+        self.num_threads = num_threads
+        torch.set_num_threads(num_threads)
+
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError as e:
+                print(f"WARNING: Could not set the number of inter-op threads: {e}")
+
+    @staticmethod
+    def from_env(**fen_options):
+        """Creates an engine configured by the environment variables `TORCH_NUM_THREADS`,
+        `TORCH_NUM_INTEROP_THREADS` and `INFERENCE_SLOTS`."""
+
+        def optional_int(name):
+            value = os.getenv(name, "")
+            return int(value) if value != "" else None
+
+        return InferenceEngine(
+            num_threads=optional_int("TORCH_NUM_THREADS"),
+            num_interop_threads=optional_int("TORCH_NUM_INTEROP_THREADS"),
+            num_slots=optional_int("INFERENCE_SLOTS") or 1,
+            **fen_options,
+        )
 
-            if auto_rotate_board and result.board_is_flipped:
-                board = rotate_board(board)
+    def warm_up(self):
+        """Loads all models now instead of on the first request."""
+        for some_model in self.models.values():
+            some_model.get()
 
-            result.fen = board.fen()
+    def get_fen_batch(self, imgs: list, cache: FenCache = None) -> list:
+        """Like `get_fen_batch`, with the options of this engine. Blocks until an inference slot is free."""
+        with self.slots, torch.no_grad():
+            return get_fen_batch(imgs, cache=cache, **self.fen_options)
 
-    return result
+    def get_fen(self, img: Image.Image, cache: FenCache = None):
+        return self.get_fen_batch([img], cache=cache)[0]
 
 
 if __name__ == "__main__":
@@ -1,12 +1,22 @@
 import os
 import sys
+import argparse
 import chess
 import chess.pgn
 from PIL import Image
 from chess_diagram_to_fen import get_fen
+from src.fen_cache import FenCache
+from src import profiling
+
+# Results are kept across runs, so that processing the same images again is fast
+cache = FenCache.from_env(
+    default_disk_path=os.path.expanduser(
+        "~/.cache/chess_diagram_to_fen/fen_cache.sqlite"
+    )
+)
 
 
-def process_image_file(file_path):
+def process_image_file(file_path, profile_dir=None):
     # Extract filename without extension to use as player name
     filename = os.path.splitext(os.path.basename(file_path))[0]
 
@@ -19,9 +29,24 @@ def process_image_file(file_path):
     try:
         # Process image and get FEN
         img = Image.open(file_path)
-        result = get_fen(
-            img=img, num_tries=10, auto_rotate_image=True, auto_rotate_board=True
-        )
+        if profile_dir is not None:
+            # Cached results would skip everything that should be profiled
+            with profiling.profile(profile_dir, filename) as paths:
+                result = get_fen(
+                    img=img,
+                    num_tries=10,
+                    auto_rotate_image=True,
+                    auto_rotate_board=True,
+                )
+            print("profile:", paths["trace"], paths["table"])
+        else:
+            result = get_fen(
+                img=img,
+                num_tries=10,
+                auto_rotate_image=True,
+                auto_rotate_board=True,
+                cache=cache,
+            )
 
         # Get the base FEN and modify the side to move
         fen_parts = result.fen.split()
@@ -54,11 +79,19 @@ def create_pgn_game(fen_data):
 
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python evgeny.py <target_directory>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Recognizes the chess diagrams in a directory and writes them to puzzles.pgn"
+    )
+    parser.add_argument("target_dir", type=str, help="directory with the images")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="profile each image with torch.profiler and write the traces and tables to this directory",
+    )
+    args = parser.parse_args()
 
-    target_dir = sys.argv[1]
+    target_dir = args.target_dir
     if not os.path.isdir(target_dir):
         print(f"Error: {target_dir} is not a valid directory")
         sys.exit(1)
@@ -70,7 +103,7 @@ def main():
     for filename in os.listdir(target_dir):
         if os.path.splitext(filename)[1].lower() in image_extensions:
             file_path = os.path.join(target_dir, filename)
-            result = process_image_file(file_path)
+            result = process_image_file(file_path, profile_dir=args.profile)
             if result:
                 game = create_pgn_game(result)
                 games.append(game)
@@ -86,6 +119,8 @@ def main():
     print(
         f"Successfully processed {len(games)} puzzles. Output written to {output_file}"
     )
+    if cache is not None:
+        print("Cache:", cache.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+import argparse
+import time
+import torch
+
+import chess_diagram_to_fen as c2f
+from src import compiled
+
+
+@torch.no_grad()
+def measure(model, input, number):
+    model(input)
+    start = time.perf_counter()
+    for _ in range(number):
+        output = model(input)
+    return output, (time.perf_counter() - start) / number
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compiles the models to frozen TorchScript graphs and stores them, "
+        "so that processes with COMPILED_MODELS don't have to compile them on their first requests"
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=list(c2f.all_models.keys()),
+        choices=list(c2f.all_models.keys()),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="where to store the compiled graphs (default: COMPILED_MODEL_DIR or ~/.cache/chess_diagram_to_fen/compiled)",
+    )
+    parser.add_argument(
+        "--benchmark_batch_size",
+        type=int,
+        default=8,
+        help="batch size for the comparison with eager execution",
+    )
+    parser.add_argument("--number", type=int, default=5, help="repetitions")
+    args = parser.parse_args()
+
+    for name in args.models:
+        some_model = c2f.all_models[name]
+        eager = some_model.get()
+        model = compiled.CompiledModel(
+            eager,
+            some_model.input_shape,
+            some_model.checkpoint_path(),
+            c2f.device,
+            cache_dir=args.cache_dir,
+        )
+
+        start = time.perf_counter()
+        model.graph()
+        print(
+            f"{name}: graph ready in {time.perf_counter() - start:.1f} s ({model.artefact_path()})"
+        )
+
+        input = torch.rand(
+            [args.benchmark_batch_size] + some_model.input_shape[1:], device=c2f.device
+        )
+        eager_output, eager_time = measure(eager, input, args.number)
+        compiled_output, compiled_time = measure(model, input, args.number)
+        print(
+            f"    eager: {eager_time * 1000:.1f} ms   compiled: {compiled_time * 1000:.1f} ms   "
+            f"max difference: {(eager_output - compiled_output).abs().max().item():.2e}"
+        )
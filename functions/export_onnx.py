@@ -0,0 +1,115 @@
+import argparse
+import os
+import random
+import sys
+import time
+import torch
+from PIL import Image
+
+import chess_diagram_to_fen as c2f
+from benchmarks import FEN_OPTIONS
+from src import common, onnx_backend
+
+
+def export_models(names, out_dir, opset):
+    """Exports the models `names` to ONNX and checks their outputs against PyTorch. Returns the paths of the files."""
+    paths = {}
+    for name in names:
+        some_model = c2f.all_models[name]
+        path = c2f.onnx_checkpoint_path(some_model.model_path)
+        if out_dir is not None:
+            path = os.path.join(out_dir, os.path.basename(path))
+
+        model = some_model.get()
+        # The batch size of the example is not 1, so that it isn't mistaken for a constant
+        example_input = torch.rand([2] + some_model.input_shape[1:], device=c2f.device)
+        with torch.no_grad():
+            model(example_input)
+        onnx_backend.export(model, example_input, path, opset=opset)
+
+        input = torch.rand([3] + some_model.input_shape[1:])
+        with torch.no_grad():
+            output = model(input.to(c2f.device)).cpu()
+        difference = (output - onnx_backend.OnnxModel(path)(input)).abs().max()
+        print(f"Exported {path}, max difference to PyTorch: {difference.item():.2e}")
+        paths[name] = path
+    return paths
+
+
+def get_fens(files):
+    """The FENs of `files` and the seconds they took. The random test-time augmentations are seeded the same way
+    for every backend, and the models are loaded and warmed up before the time is measured.
+    """
+    if len(files) > 0:
+        c2f.get_fen(Image.open(files[0]), **FEN_OPTIONS)
+
+    fens = []
+    elapsed = 0.0
+    for i, f in enumerate(files):
+        random.seed(i)
+        torch.manual_seed(i)
+        start = time.perf_counter()
+        result = c2f.get_fen(Image.open(f), **FEN_OPTIONS)
+        elapsed += time.perf_counter() - start
+        fens.append(None if result is None else result.fen)
+    return fens, elapsed
+
+
+def check_parity(files, paths):
+    """Compares the FENs of PyTorch and ONNX Runtime for `files`. Returns `True` if they are all the same."""
+    for some_model in c2f.all_models.values():
+        some_model.set_onnx_model_path(None)
+    torch_fens, torch_time = get_fens(files)
+
+    for name, path in paths.items():
+        c2f.all_models[name].set_onnx_model_path(path)
+    onnx_fens, onnx_time = get_fens(files)
+
+    mismatches = [
+        (f, torch_fen, onnx_fen)
+        for f, torch_fen, onnx_fen in zip(files, torch_fens, onnx_fens)
+        if torch_fen != onnx_fen
+    ]
+    for f, torch_fen, onnx_fen in mismatches:
+        print(f"{f}:\n  torch: {torch_fen}\n  onnx:  {onnx_fen}")
+
+    print(
+        f"{len(files) - len(mismatches)} of {len(files)} FENs are the same "
+        f"(torch: {torch_time / max(len(files), 1) * 1000:.1f} ms/image, "
+        f"onnx: {onnx_time / max(len(files), 1) * 1000:.1f} ms/image)"
+    )
+    return len(mismatches) == 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Exports the models to ONNX, with a dynamic batch axis, for the ONNX Runtime backend"
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=list(c2f.all_models.keys()),
+        choices=list(c2f.all_models.keys()),
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        default=None,
+        help="where to store the ONNX files (default: next to the PyTorch checkpoints)",
+    )
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument(
+        "--check",
+        type=str,
+        default=None,
+        help="directory with images, to check that both backends find the same FENs",
+    )
+    args = parser.parse_args()
+
+    paths = export_models(args.models, args.out_dir, args.opset)
+
+    if args.check is not None:
+        files = common.glob_all_image_files_recursively(args.check)
+        if not check_parity(files, paths):
+            sys.exit(1)
@@ -0,0 +1,73 @@
+"""gunicorn settings for serving with several worker processes that share the models.
+
+Usage (from the `functions` directory):
+    gunicorn --config gunicorn.conf.py wsgi:app
+"""
+
+import glob
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from src import memory
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_WORKERS", "2"))
+# Concurrent requests of a worker are batched together, see MICRO_BATCH_MAX_SIZE
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+# Load the models in the parent process, before the workers are forked
+preload_app = True
+# Cloud Run enforces the request timeout
+timeout = 0
+
+# Split the cores between the workers and their inference slots instead of letting every batch use all of them
+if "TORCH_NUM_THREADS" not in os.environ:
+    cpus = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else os.cpu_count() or 1
+    )
+    slots = int(os.getenv("INFERENCE_SLOTS", "") or 1)
+    os.environ["TORCH_NUM_THREADS"] = str(max(1, cpus // (workers * slots)))
+
+# The workers write their metrics to files in this directory, and /metrics adds up those of all workers. It is set up
+# here, before the app is preloaded, and old files of earlier runs are removed.
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+else:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="fen_metrics_")
+
+
+def report_memory(pid):
+    # Once after the workers have started, then every MEMORY_REPORT_INTERVAL seconds (if set)
+    interval = float(os.getenv("MEMORY_REPORT_INTERVAL", "0"))
+    time.sleep(10)
+    while True:
+        print(memory.memory_report(pid), flush=True)
+        if interval <= 0:
+            return
+        time.sleep(interval)
+
+
+def when_ready(server):
+    threading.Thread(target=report_memory, args=(os.getpid(),), daemon=True).start()
+
+
+def post_worker_init(worker):
+    print(
+        f"Worker {os.getpid()}: {memory.format_memory(memory.process_memory())}",
+        flush=True,
+    )
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # The gauges of a worker that is gone no longer count
+    multiprocess.mark_process_dead(worker.pid)
@@ -4,63 +4,454 @@ import chess
 import chess.pgn
 import tempfile
 import io
-from chess_diagram_to_fen import get_fen
+import os
+from chess_diagram_to_fen import (
+    InferenceEngine,
+    cache_key,
+    decode_image,
+    fen_result_from_dict,
+    fen_result_to_dict,
+    use_quantized_models,
+    use_onnx_models,
+    use_compiled_models,
+    use_precision,
+    use_tile_deduplication,
+)
+from src.batching import MicroBatcher
+from src.fen_cache import FenCache
 import base64
 import re
 import json
+import time
+from contextlib import nullcontext
+from concurrent.futures import Future, as_completed
+from flask import Response
+from src import instrumentation, profiling
+import prometheus_client
+from prometheus_client import multiprocess
+
+# Comma separated names of models that run with INT8 weights, e.g. "fen_model,bbox_model". See README.
+use_quantized_models(
+    [name for name in os.getenv("QUANTIZED_MODELS", "").split(",") if name != ""]
+)
+# Comma separated names of models that run with ONNX Runtime. See README.
+use_onnx_models(
+    [name for name in os.getenv("ONNX_MODELS", "").split(",") if name != ""]
+)
+# Comma separated names of models that run as compiled graphs. See README.
+use_compiled_models(
+    [name for name in os.getenv("COMPILED_MODELS", "").split(",") if name != ""]
+)
+# Memory format and precision of all models. See README.
+use_precision(
+    channels_last=os.getenv("CHANNELS_LAST", "0") == "1",
+    bf16=os.getenv("BF16_AUTOCAST", "0") == "1",
+)
+
+# Encode identical squares of the FEN model only once, and cache tile embeddings across requests. See README.
+use_tile_deduplication(
+    deduplicate=os.getenv("TILE_DEDUPLICATION", "0") == "1",
+    cache_size=int(os.getenv("TILE_CACHE_ENTRIES", "0")),
+)
+
+FEN_OPTIONS = dict(num_tries=10, auto_rotate_image=True, auto_rotate_board=True)
+
+# Shorter side in pixels down to which JPEGs are scaled while decoding, 0 decodes them at full resolution. See README.
+DECODE_MIN_SIZE = int(os.getenv("DECODE_MIN_SIZE", "1024"))
+
+# Threads and concurrent inference slots. See README.
+engine = InferenceEngine.from_env(**FEN_OPTIONS)
+
+
+def infer_batch(imgs: list) -> list:
+    """Infers a batch of the micro-batcher, and records the timings and counts of the batch."""
+    if METRICS:
+        queue_depth.set(batcher.queue.qsize())
+    with instrumentation.collect() as timings:
+        results = engine.get_fen_batch(imgs)
+
+    if METRICS:
+        batch_sizes.observe(len(imgs))
+    for result in results:
+        if result is None:
+            continue
+        result.timings = timings
+        if METRICS and result.num_bbox_iterations is not None:
+            bbox_iterations.observe(result.num_bbox_iterations)
+        if METRICS and result.num_tries_used is not None:
+            tta_tries.observe(result.num_tries_used)
+    return results
+
+
+# Concurrent requests are answered by batched inference. See README for the trade-off of these settings.
+batcher = MicroBatcher(
+    infer_batch,
+    max_batch_size=int(os.getenv("MICRO_BATCH_MAX_SIZE", "8")),
+    max_wait_ms=float(os.getenv("MICRO_BATCH_WINDOW_MS", "10")),
+    num_workers=engine.num_slots,
+)
+
+# Maximum number of images in one request to the batch endpoint
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "256"))
+
+# Results for images that were already seen. See README for the settings.
+cache = FenCache.from_env()
+
+# Requests with the header `X-Profile: 1` are profiled to this directory, at most once per
+# PROFILE_MIN_INTERVAL_S seconds. Profiling is off if PROFILE_DIR is empty. See README.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+profile_rate_limit = profiling.RateLimit(
+    float(os.getenv("PROFILE_MIN_INTERVAL_S", "60"))
+)
+
+# Prometheus metrics on /metrics. METRICS=0 turns them off. With gunicorn, PROMETHEUS_MULTIPROC_DIR is set (see
+# gunicorn.conf.py) and the metrics of all workers are added up. See README.
+METRICS = os.getenv("METRICS", "1") == "1"
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+stage_seconds = prometheus_client.Histogram(
+    "fen_stage_seconds",
+    "Time spent in each stage, including queue waits and model loading",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+request_seconds = prometheus_client.Histogram(
+    "fen_request_seconds",
+    "Time until the response starts",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+responses = prometheus_client.Counter(
+    "fen_responses", "Responses by status code", ["status"]
+)
+batch_sizes = prometheus_client.Histogram(
+    "fen_batch_size", "Images per inference batch", buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+bbox_iterations = prometheus_client.Histogram(
+    "fen_bbox_iterations", "Bbox model passes per image", buckets=(1, 2, 3, 5, 10)
+)
+tta_tries = prometheus_client.Histogram(
+    "fen_tta_tries",
+    "Test-time augmentation tries per board",
+    buckets=(1, 2, 4, 6, 8, 10, 20),
+)
+queue_depth = prometheus_client.Gauge(
+    "fen_queue_depth",
+    "Images waiting for an inference batch",
+    multiprocess_mode="livesum",
+)
+cache_hits = prometheus_client.Counter("fen_cache_hits", "Result cache hits")
+cache_misses = prometheus_client.Counter("fen_cache_misses", "Result cache misses")
+if METRICS:
+    instrumentation.observers.append(
+        lambda name, seconds: stage_seconds.labels(name).observe(seconds)
+    )
+
+
+def record_response(endpoint: str, status: int, seconds: float):
+    if METRICS:
+        request_seconds.labels(endpoint).observe(seconds)
+        responses.labels(str(status)).inc()
+
+
+def metrics_text() -> bytes:
+    """The metrics in the Prometheus text format, of all workers if PROMETHEUS_MULTIPROC_DIR is set."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return prometheus_client.generate_latest()
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
+
+
+def metrics_response():
+    if not METRICS:
+        return {"error": "Metrics are disabled"}, 404
+    return Response(metrics_text(), content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def request_timings(timings: dict, result, seconds: float) -> dict:
+    """Milliseconds of each stage of a request: the stages that ran for the request itself (`timings`), the stages
+    of the batch it was inferred in, and the total."""
+    stages = dict(timings)
+    if result is not None and result.timings is not None:
+        for name, value in result.timings.items():
+            stages[name] = stages.get(name, 0.0) + value
+    stages["total"] = seconds
+    return {name: round(value * 1000, 3) for name, value in stages.items()}
+
+
+def submit_fen_result(img: Image.Image) -> Future:
+    """Returns a future for the FenResult of `img`, which is already done if the result is cached."""
+    with instrumentation.stage("decode"):
+        img = decode_image(img, min_size=DECODE_MIN_SIZE)
+    if cache is None:
+        return submit_to_batcher(img)
+
+    # Cache hits don't have to wait for a batch
+    key = cache_key(img, **FEN_OPTIONS)
+    found, value = cache.get(key)
+    if METRICS:
+        (cache_hits if found else cache_misses).inc()
+    if found:
+        future = Future()
+        future.set_result(fen_result_from_dict(value))
+        return future
+
+    def store(future):
+        if not future.cancelled() and future.exception() is None:
+            cache.put(key, fen_result_to_dict(future.result()))
+
+    future = submit_to_batcher(img)
+    future.add_done_callback(store)
+    return future
+
+
+def submit_to_batcher(img: Image.Image) -> Future:
+    future = batcher.submit(img)
+    if METRICS:
+        queue_depth.set(batcher.queue.qsize())
+    return future
+
+
+def profile_fen_result(img: Image.Image):
+    """Infers `img` on this thread while it is profiled, without the cache and the micro-batcher, so that the
+    profile only contains this image. Returns the FenResult and the name of the profile in `PROFILE_DIR`.
+    """
+    name = profiling.profile_name("request")
+    with profiling.profile(PROFILE_DIR, name):
+        with instrumentation.stage("decode"):
+            img = decode_image(img, min_size=DECODE_MIN_SIZE)
+        result = engine.get_fen(img)
+    return result, name
+
+
+def get_fen_result(img: Image.Image):
+    """Returns the FenResult for `img`, from the cache if possible."""
+    return submit_fen_result(img).result()
+
+
+def fen_with_side_to_move(result, side_to_move: str) -> str:
+    if result is None or result.fen is None:
+        raise Exception("No chessboard found")
+    fen_parts = result.fen.split()
+    fen_parts[1] = side_to_move
+    return " ".join(fen_parts)
+
+
+def image_from_data_url(image_data_url: str) -> io.BytesIO:
+    """The image file of a base64 encoded data URL. Raises `ValueError` if `image_data_url` isn't one."""
+    data_url_pattern = r"^data:image/(?:jpeg|png|jpg|gif);base64,"
+    if not isinstance(image_data_url, str) or not re.match(
+        data_url_pattern, image_data_url
+    ):
+        raise ValueError("Invalid image data URL format")
+    try:
+        with instrumentation.stage("base64"):
+            return io.BytesIO(base64.b64decode(image_data_url.split(",")[1]))
+    except base64.binascii.Error:
+        raise ValueError("Invalid base64 encoding")
+
+
+def side_to_move_of(request, default=None):
+    """Side to move from the query parameter `side` or the header `X-Side-To-Move` (default `w`)."""
+    side_to_move = (
+        request.args.get("side")
+        or request.headers.get("X-Side-To-Move")
+        or default
+        or "w"
+    ).lower()
+    if side_to_move not in ["w", "b"]:
+        side_to_move = "w"
+    return side_to_move
 
 
 @functions_framework.http
 def process_chess_image(request):
-    """HTTP Cloud Function that processes a base64 encoded chess image and returns FEN."""
+    """HTTP Cloud Function that processes a chess image and returns FEN.
 
-    # Ensure the request has a JSON body
-    if not request.is_json:
-        return {"error": "Request must be JSON"}, 400
+    The image can be sent as
+    - the raw body with an `image/*` content type, with the side to move as query parameter `side` or header
+    `X-Side-To-Move`,
+    - a multipart upload with the file field `image` (and optionally the field `side`), or
+    - JSON with a base64 encoded data URL `image` and `side`.
 
-    request_json = request.get_json()
+    With the query parameter `timings=1` or the header `X-Timings: 1`, the response also contains the milliseconds
+    spent in each stage. With the header `X-Profile: 1`, the inference is profiled (see `PROFILE_DIR`). Requests to
+    the path `/batch` are answered by `process_chess_images`, and `/metrics` returns the metrics in the Prometheus
+    text format.
+    """
 
-    # Check if image data is in request
-    if not request_json or "image" not in request_json:
-        return {"error": "No image data provided"}, 400
+    path = request.path.rstrip("/")
+    if path == "/metrics":
+        return metrics_response()
 
-    # Get the base64 image string
-    image_data_url = request_json["image"]
+    start = time.perf_counter()
+    if path == "/batch":
+        endpoint = "batch"
+        response = process_chess_images(request)
+    else:
+        endpoint = "image"
+        wants_timings = (
+            request.args.get("timings") == "1"
+            or request.headers.get("X-Timings") == "1"
+        )
+        with instrumentation.collect() if wants_timings else nullcontext() as timings:
+            response = fen_response(request, timings, start)
 
-    # Validate data URL format
-    data_url_pattern = r"^data:image/(?:jpeg|png|jpg|gif);base64,"
-    if not re.match(data_url_pattern, image_data_url):
-        return {"error": "Invalid image data URL format"}, 400
+    status = response[1] if isinstance(response, tuple) else response.status_code
+    record_response(endpoint, status, time.perf_counter() - start)
+    return response
 
-    try:
-        # Extract the base64 data part
-        base64_data = image_data_url.split(",")[1]
 
-        # Decode base64 to bytes
-        image_bytes = base64.b64decode(base64_data)
+def fen_response(request, timings=None, start=None):
+    """Answers a request to `process_chess_image` with one image. If `timings` is a dict in which the stages of
+    this request are collected, the response contains them."""
 
-        # Convert bytes to PIL Image
-        img = Image.open(io.BytesIO(image_bytes))
+    profiled = request.headers.get("X-Profile") == "1"
+    if profiled and PROFILE_DIR == "":
+        return {"error": "Profiling is disabled"}, 403
+
+    if request.mimetype.startswith("image/"):
+        # BytesIO shares the buffer of the bytes object instead of copying it
+        image_file = io.BytesIO(request.get_data(cache=False))
+        side_to_move = side_to_move_of(request)
+
+    elif request.mimetype == "multipart/form-data":
+        if "image" not in request.files:
+            return {"error": "No image file provided"}, 400
+        image_file = request.files["image"].stream
+        side_to_move = side_to_move_of(request, request.form.get("side"))
+
+    elif request.is_json:
+        request_json = request.get_json()
+
+        # Check if image data is in request
+        if not request_json or "image" not in request_json:
+            return {"error": "No image data provided"}, 400
+
+        try:
+            # Decode the base64 image string
+            image_file = image_from_data_url(request_json["image"])
+        except ValueError as e:
+            return {"error": str(e)}, 400
 
         # Get side to move from JSON (default to 'w')
         side_to_move = request_json.get("side", "w").lower()
         if side_to_move not in ["w", "b"]:
             side_to_move = "w"
 
-        # Process image and get FEN
-        result = get_fen(
-            img=img, num_tries=10, auto_rotate_image=True, auto_rotate_board=True
-        )
+    else:
+        return {"error": "Request must be JSON, an image, or a multipart upload"}, 400
 
-        # Modify FEN with correct side to move
-        fen_parts = result.fen.split()
-        fen_parts[1] = side_to_move
-        modified_fen = " ".join(fen_parts)
+    try:
+        # Convert bytes to PIL Image
+        img = Image.open(image_file)
 
-        # Return the FEN string
-        return {"fen": modified_fen}, 200
+        # Only requests with an image use up the rate limit of the profiles
+        if profiled and not profile_rate_limit.try_acquire():
+            return {
+                "error": f"At most one profile per {profile_rate_limit.min_interval_s:g} seconds"
+            }, 429
+
+        # Process image and get FEN with correct side to move
+        if profiled:
+            result, profile_name = profile_fen_result(img)
+        else:
+            result = get_fen_result(img)
+        response = {"fen": fen_with_side_to_move(result, side_to_move)}
+        if profiled:
+            response["profile"] = profile_name
 
-    except base64.binascii.Error:
-        return {"error": "Invalid base64 encoding"}, 400
     except Exception as e:
         return {"error": str(e)}, 500
+
+    if timings is not None:
+        response["timings"] = request_timings(
+            timings, result, time.perf_counter() - start
+        )
+    return response, 200
+
+
+def batch_images(request) -> list:
+    """`(id, image file or data URL, side to move)` of each image in a batch request, see `process_chess_images`.
+    Raises `ValueError` if the request is malformed."""
+    if request.mimetype == "multipart/form-data":
+        default_side = side_to_move_of(request, request.form.get("side"))
+        images = []
+        for image_id, file in request.files.items(multi=True):
+            side_to_move = request.form.get(f"side.{image_id}", default_side).lower()
+            # Copied, because the response is streamed after Flask has closed the uploads, and small boards in
+            # large JPEGs are decoded again from the original file (see `decode_image`)
+            images.append((image_id, io.BytesIO(file.read()), side_to_move))
+        return images
+
+    if request.is_json:
+        request_json = request.get_json(silent=True)
+        if not isinstance(request_json, dict) or not isinstance(
+            request_json.get("images"), list
+        ):
+            raise ValueError('JSON must contain a list "images"')
+        default_side = side_to_move_of(request, request_json.get("side"))
+        images = []
+        for i, entry in enumerate(request_json["images"]):
+            if not isinstance(entry, dict) or "image" not in entry:
+                raise ValueError(f"Image {i} has no image data")
+            side_to_move = str(entry.get("side", default_side)).lower()
+            images.append((str(entry.get("id", i)), entry["image"], side_to_move))
+        return images
+
+    raise ValueError("Request must be JSON or a multipart upload")
+
+
+@functions_framework.http
+def process_chess_images(request):
+    """HTTP Cloud Function that processes many chess images in one request and streams their FENs.
+
+    The images are sent as
+    - a multipart upload with one file per image, whose field name is the id of the image. The side to move is the
+    field `side.<id>`, or for all images the field `side`, the query parameter `side` or the header
+    `X-Side-To-Move`, or
+    - JSON `{"images": [{"id": ..., "image": <base64 data URL>, "side": ...}, ...], "side": ...}`.
+
+    All images are inferred in batches. The response is NDJSON with one line `{"id": ..., "fen": ...}` or
+    `{"id": ..., "error": ...}` per image, in the order in which the images are finished.
+    """
+
+    try:
+        images = batch_images(request)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if len(images) == 0:
+        return {"error": "No images provided"}, 400
+    if len(images) > BATCH_MAX_IMAGES:
+        return {"error": f"At most {BATCH_MAX_IMAGES} images per request"}, 413
+
+    # Everything is read from the request before the response starts streaming
+    futures = {}
+    lines = []
+    for image_id, image_file, side_to_move in images:
+        if side_to_move not in ["w", "b"]:
+            side_to_move = "w"
+        try:
+            if not hasattr(image_file, "read"):
+                image_file = image_from_data_url(image_file)
+            future = submit_fen_result(Image.open(image_file))
+            futures[future] = (image_id, side_to_move)
+        except Exception as e:
+            lines.append({"id": image_id, "error": str(e)})
+
+    def results():
+        for line in lines:
+            yield json.dumps(line) + "\n"
+        for future in as_completed(futures):
+            image_id, side_to_move = futures[future]
+            try:
+                line = {
+                    "id": image_id,
+                    "fen": fen_with_side_to_move(future.result(), side_to_move),
+                }
+            except Exception as e:
+                line = {"id": image_id, "error": str(e)}
+            yield json.dumps(line) + "\n"
+
+    return Response(results(), mimetype="application/x-ndjson")
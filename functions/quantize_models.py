@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import torch
+from PIL import Image
+
+import chess_diagram_to_fen as c2f
+from src import common, quantization
+from benchmarks import FEN_OPTIONS, peak_rss_mb, percentile, square_accuracy
+
+
+def load_images(files):
+    return [Image.open(f).convert("RGB") for f in files]
+
+
+@torch.no_grad()
+def calibrate_and_quantize(names, files, out_dir, batch_size):
+    """Runs the pipeline with observers in the models `names` over the images `files`, then stores the quantized
+    checkpoints. Returns the paths of the checkpoints."""
+    for name in names:
+        some_model = c2f.all_models[name]
+        some_model.model = quantization.prepare(
+            some_model.get(), torch.zeros(some_model.input_shape)
+        )
+
+    for start in range(0, len(files), batch_size):
+        c2f.get_fen_batch(load_images(files[start : start + batch_size]), **FEN_OPTIONS)
+        print(
+            f"Calibrated with {min(start + batch_size, len(files))} of {len(files)} images"
+        )
+
+    paths = {}
+    for name in names:
+        some_model = c2f.all_models[name]
+        path = c2f.quantized_checkpoint_path(some_model.model_path)
+        if out_dir is not None:
+            path = os.path.join(out_dir, os.path.basename(path))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        torch.save(quantization.convert(some_model.model).state_dict(), path)
+        some_model.set_model_path(some_model.model_path)
+        paths[name] = path
+        print(f"Saved {path}")
+    return paths
+
+
+def evaluate(files, quantized_paths):
+    """Runs the pipeline over `files`, with the INT8 checkpoints `quantized_paths` (model name -> path), and
+    prints the FENs, latency and peak RSS as JSON."""
+    for name, path in quantized_paths.items():
+        c2f.all_models[name].set_quantized_model_path(path)
+
+    start = time.perf_counter()
+    for some_model in c2f.all_models.values():
+        some_model.get()
+    load_time = time.perf_counter() - start
+
+    fens, latencies = [], []
+    for img in load_images(files):
+        start = time.perf_counter()
+        result = c2f.get_fen(img, **FEN_OPTIONS)
+        latencies.append(time.perf_counter() - start)
+        fens.append(None if result is None else result.fen)
+
+    print(
+        json.dumps(
+            {
+                "fens": fens,
+                "latencies": latencies,
+                "load_time": load_time,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+        )
+    )
+
+
+def run_evaluation(files, quantized_paths):
+    # A fresh process for each configuration, so that the peak RSS of one doesn't hide the other
+    output = subprocess.run(
+        [sys.executable, __file__, "--evaluate", json.dumps(quantized_paths), "--files"]
+        + [str(f) for f in files],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def report(fp32, int8):
+    print()
+    print(f"{'':<24}{'fp32':>12}{'int8':>12}")
+    for label, key in [
+        ("model loading (s)", "load_time"),
+        ("peak RSS (MB)", "peak_rss_mb"),
+    ]:
+        print(f"{label:<24}{fp32[key]:>12.2f}{int8[key]:>12.2f}")
+    for p in [50, 90, 99]:
+        print(
+            f"{f'latency p{p} (ms)':<24}{percentile(fp32['latencies'], p) * 1000:>12.1f}{percentile(int8['latencies'], p) * 1000:>12.1f}"
+        )
+
+    pairs = list(zip(int8["fens"], fp32["fens"]))
+    same = sum(fen == reference for fen, reference in pairs) / len(pairs)
+    squares = sum(square_accuracy(fen, reference) for fen, reference in pairs) / len(
+        pairs
+    )
+    print()
+    print(f"Same FEN as fp32: {same * 100:.1f}% of {len(pairs)} images")
+    print(f"Same square as fp32: {squares * 100:.2f}%")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Creates INT8 checkpoints of the models by calibrating them on sample images, and compares "
+        "them against the full precision models"
+    )
+    parser.add_argument(
+        "--dir",
+        type=str,
+        help="directory with calibration images, e.g. ../puzzles/",
+    )
+    parser.add_argument(
+        "--eval_dir",
+        type=str,
+        default=None,
+        help="directory with images for the comparison (default: --dir)",
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=list(c2f.all_models.keys()),
+        choices=list(c2f.all_models.keys()),
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        default=None,
+        help="where to store the quantized checkpoints (default: next to the full precision checkpoints)",
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--evaluate", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--files", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.evaluate is not None:
+        evaluate(args.files, json.loads(args.evaluate))
+        sys.exit(0)
+
+    if args.dir is None:
+        parser.error("--dir is required")
+
+    if c2f.device.type != "cpu":
+        raise Exception(
+            'Quantized models only run on the CPU. Run with CUDA_VISIBLE_DEVICES="".'
+        )
+
+    files = common.glob_all_image_files_recursively(args.dir)
+    print(f"Found {len(files)} calibration images")
+    paths = calibrate_and_quantize(args.models, files, args.out_dir, args.batch_size)
+
+    eval_files = common.glob_all_image_files_recursively(args.eval_dir or args.dir)
+    print(f"Comparing on {len(eval_files)} images")
+    report(run_evaluation(eval_files, {}), run_evaluation(eval_files, paths))
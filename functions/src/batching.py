@@ -0,0 +1,96 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from src import instrumentation
+
+
+class MicroBatcher:
+    """Collects items that are submitted from many threads and processes them together in batches.
+
+    A batch is processed as soon as `max_batch_size` items are waiting, or `max_wait_ms` milliseconds after
+    its first item arrived. A longer window and a larger batch size give higher throughput under load, but
+    a single request may wait up to `max_wait_ms` for company, which raises the p50 latency when traffic is
+    low. A smaller batch size bounds the time of each batch and therefore the p99 latency.
+
+    Args:
+        - `process_batch (Callable[[list], list])`: Processes a list of items and returns a list with one
+        result per item, in the same order.
+        - `max_batch_size (int)`: Maximum number of items processed together.
+        - `max_wait_ms (float)`: How long the first item of a batch waits for more items.
+        - `num_workers (int)`: How many batches may be processed at the same time.
+    """
+
+    def __init__(
+        self, process_batch, max_batch_size=8, max_wait_ms=10.0, num_workers=1
+    ) -> None:
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.num_workers = num_workers
+        self.queue = queue.Queue()
+        self.workers = []
+        self.worker_lock = threading.Lock()
+
+    def submit(self, item) -> Future:
+        """Queues `item` and returns a future that resolves to its result."""
+        future = Future()
+        self._ensure_worker()
+        self.queue.put((item, future, time.monotonic()))
+        return future
+
+    def __call__(self, item):
+        """Queues `item` and blocks until its result is available."""
+        return self.submit(item).result()
+
+    def _ensure_worker(self):
+        # The worker threads are started lazily, so that they also exist in forked processes
+        with self.worker_lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(
+                    target=self._run, name="micro-batcher", daemon=True
+                )
+                worker.start()
+                self.workers.append(worker)
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _process(self, batch: list):
+        try:
+            results = self.process_batch([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Don't let a single bad item fail the whole batch
+            for entry in batch:
+                self._process([entry])
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = []
+            items = self._next_batch()
+            now = time.monotonic()
+            for item, future, submitted in items:
+                if future.set_running_or_notify_cancel():
+                    instrumentation.record("queue", now - submitted)
+                    batch.append((item, future))
+            if len(batch) > 0:
+                self._process(batch)
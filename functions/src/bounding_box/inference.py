@@ -1,40 +1,138 @@
 import torch
 import torchvision
 
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-import skimage.measure
-import skimage.morphology
+# Connected components are labelled on masks that are downsampled by this factor
+LABEL_DOWNSAMPLE_FACTOR = 4
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+def predict_masks(model, imgs: torch.Tensor) -> torch.Tensor:
+    """Returns the predicted chessboard probability maps `[B, 1, H, W]` for the batch `imgs`.
 
-def get_bbox(model, img: torch.Tensor):
-    model.eval()
-    model.to(device)
+    The model is expected to already be in eval mode and on `device`.
+    """
     with torch.no_grad():
         assert (
-            len(img.shape) == 3
-        ), "Need input to be of shape [C, H, W] but is: " + str(img.shape)
-        assert img.shape[0] == 3, "Channel dimension must be 3 (RGB)"
-        img = img.unsqueeze(0)
-        mask = torch.where(model(img.to(device)) < 0.5, 0.0, 1.0).cpu().squeeze(1)
-        mask = mask.to(bool).numpy()
-        labelled = skimage.measure.label(mask)
-        rp = skimage.measure.regionprops(labelled)
-        size = max([i.area for i in rp] + [1])
-        mask = skimage.morphology.remove_small_objects(mask, min_size=size - 1)
-        mask = torch.tensor(mask).to(float)
-
-
-        # from matplotlib import pyplot as plt
-        # fig, (ax1, ax2) = plt.subplots(1, 2)
-        # ax1.imshow(mask.squeeze(0))
-        # ax2.imshow(mask.squeeze(0))
-        # plt.show()
-
-        if len(torch.nonzero(mask)) == 0:
-            return None
-        output_box = torchvision.ops.masks_to_boxes(mask)
-
-    model.train()
-    return output_box.squeeze(0)
+            len(imgs.shape) == 4
+        ), "Need input to be of shape [B, C, H, W] but is: " + str(imgs.shape)
+        assert imgs.shape[1] == 3, "Channel dimension must be 3 (RGB)"
+        return model(imgs.to(device)).cpu()
+
+
+def run_max(labels: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Sets every label of a run of `True` in the rows of `mask` `[N, L]` to the largest label of that run."""
+    previous = torch.nn.functional.pad(mask[:, :-1], (1, 0), value=False)
+    run_ids = (mask & ~previous).cumsum(dim=1)
+
+    # Offsetting the labels by their run makes cummax restart at every run.
+    # Forwards, the last element of each run gets the maximum of the run; backwards, the other elements get it too
+    scale = labels.max() + 1
+    forward = (run_ids * scale + labels).cummax(dim=1).values - run_ids * scale
+    reverse_ids = run_ids.max(dim=1, keepdim=True).values - run_ids
+    backward = (reverse_ids * scale + forward).flip(1).cummax(dim=1).values.flip(
+        1
+    ) - reverse_ids * scale
+
+    return torch.where(mask, backward, 0)
+
+
+def label_components(mask: torch.Tensor) -> torch.Tensor:
+    """Labels the 8-connected components of the boolean masks `[B, H, W]`.
+
+    Every pixel of a component gets the same label greater than zero, background pixels get zero.
+    """
+    b, h, w = mask.shape
+    labels = torch.arange(1, h * w + 1).reshape(1, h, w)
+    labels = torch.where(mask, labels, 0)
+    rows = mask.reshape(b * h, w)
+    columns = mask.transpose(1, 2).reshape(b * w, h)
+
+    # Spread the largest label along rows, columns and diagonals until every component is uniform
+    while True:
+        new_labels = run_max(labels.reshape(b * h, w), rows).reshape(b, h, w)
+        new_labels = (
+            run_max(new_labels.transpose(1, 2).reshape(b * w, h), columns)
+            .reshape(b, w, h)
+            .transpose(1, 2)
+        )
+        new_labels = torch.nn.functional.max_pool2d(
+            new_labels.unsqueeze(1).float(), 3, stride=1, padding=1
+        )
+        new_labels = torch.where(mask, new_labels.squeeze(1).long(), 0)
+        if torch.equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def largest_components(masks: torch.Tensor) -> torch.Tensor:
+    """Keeps only the largest connected region of each boolean mask `[B, H, W]`.
+
+    The regions are found on a downsampled version of the masks, so that this stays cheap for large masks.
+    """
+    b, h, w = masks.shape
+    f = LABEL_DOWNSAMPLE_FACTOR
+    pad = (0, (-w) % f, 0, (-h) % f)
+    padded = torch.nn.functional.pad(masks.float(), pad).unsqueeze(1)
+
+    # Number of mask pixels in each downsampled cell
+    cell_counts = torch.nn.functional.avg_pool2d(padded, f).squeeze(1) * (f * f)
+    labels = label_components(cell_counts > 0)
+
+    # Size of each region in full resolution pixels, the labels of image i are offset by i * num_labels
+    num_labels = labels.shape[1] * labels.shape[2] + 1
+    offsets = torch.arange(b).reshape(b, 1, 1) * num_labels
+    sizes = torch.bincount(
+        (labels + offsets).flatten(),
+        weights=cell_counts.flatten(),
+        minlength=b * num_labels,
+    ).reshape(b, num_labels)
+    sizes[:, 0] = 0
+    largest = sizes.argmax(dim=1).reshape(b, 1, 1)
+
+    keep = (labels == largest) & (largest > 0)
+    keep = keep.repeat_interleave(f, dim=1).repeat_interleave(f, dim=2)[:, :h, :w]
+    return masks & keep
+
+
+def masks_to_bboxes(masks: torch.Tensor) -> list:
+    """Returns the bounding box (or `None`) of the largest region of each probability map of the batch `masks`."""
+    masks = largest_components(masks.squeeze(1) >= 0.5)
+
+    # from matplotlib import pyplot as plt
+    # fig, (ax1, ax2) = plt.subplots(1, 2)
+    # ax1.imshow(masks[0])
+    # ax2.imshow(masks[0])
+    # plt.show()
+
+    found = masks.flatten(1).any(dim=1).tolist()
+    bboxes = [None] * len(found)
+    if any(found):
+        boxes = torchvision.ops.masks_to_boxes(masks[found].float())
+        for i, box in zip([i for i in range(len(found)) if found[i]], boxes):
+            bboxes[i] = box
+
+    return bboxes
+
+
+def mask_statistics(masks: torch.Tensor):
+    """Returns for each probability map of the batch `masks` the fraction of pixels that belong to a chessboard,
+    and the mean probability of these pixels."""
+    foreground = masks >= 0.5
+    area = foreground.flatten(1).float().mean(dim=1)
+    confidence = (masks * foreground).flatten(1).sum(dim=1) / foreground.flatten(1).sum(
+        dim=1
+    ).clamp(min=1)
+    return area, confidence
+
+
+def get_bboxes(model, imgs: torch.Tensor) -> list:
+    """Returns one bounding box (or `None`) for each image of the batch `imgs`."""
+    return masks_to_bboxes(predict_masks(model, imgs))
+
+
+def get_bbox(model, img: torch.Tensor):
+    assert len(img.shape) == 3, "Need input to be of shape [C, H, W] but is: " + str(
+        img.shape
+    )
+    return get_bboxes(model, img.unsqueeze(0))[0]
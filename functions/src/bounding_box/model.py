@@ -7,10 +7,16 @@ from torchvision import models
 
 
 class ChessBoardBBox(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
+        """`pretrained=False` skips loading the ImageNet weights of the backbone, e.g. when a checkpoint is loaded
+        afterwards anyway."""
         super(ChessBoardBBox, self).__init__()
 
-        self.model = models.segmentation.lraspp_mobilenet_v3_large()
+        self.model = models.segmentation.lraspp_mobilenet_v3_large(
+            weights_backbone=(
+                models.MobileNet_V3_Large_Weights.IMAGENET1K_V1 if pretrained else None
+            )
+        )
         self.model.classifier = models.segmentation.lraspp.LRASPPHead(40, 960, 1, 128)
 
         # print(self.model)
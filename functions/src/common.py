@@ -100,60 +100,104 @@ def square_to_idx(sq):
     return (sq % 8) + (7 - (sq // 8)) * 8
 
 
-def chess_board_to_tensor(board: chess.Board):
-    result = torch.zeros(64, len(PIECE_TYPES))
+# Index of each piece type in PIECE_TYPES
+PIECE_TYPE_INDICES = {piece: i for i, piece in enumerate(PIECE_TYPES)}
 
-    for square in chess.SQUARES:
-        sq_idx = square_to_idx(square)
-        for i, piece in enumerate(PIECE_TYPES):
-            if piece is None:
-                result[sq_idx, i] = 1.0
-            elif board.piece_at(square) == piece:
-                result[sq_idx, i] = 1.0
-                break
+EMPTY_INDEX = PIECE_TYPE_INDICES[None]
 
-    return result
+# FEN symbol for each entry of PIECE_TYPES, "1" for an empty square
+PIECE_SYMBOLS = [piece.symbol() if piece is not None else "1" for piece in PIECE_TYPES]
+
+# SQUARE_INDICES[square] is the row of the board tensor that belongs to square
+SQUARE_INDICES = [square_to_idx(square) for square in chess.SQUARES]
+
+# IDX_SQUARES[idx] is the square that belongs to row idx of the board tensor
+IDX_SQUARES = [chess.SQUARES[SQUARE_INDICES.index(idx)] for idx in range(64)]
+
+
+def _flip_color_index(i):
+    piece = PIECE_TYPES[i]
+    if piece is None:
+        return i
+    return PIECE_TYPE_INDICES[
+        chess.Piece(
+            piece.piece_type,
+            chess.BLACK if piece.color == chess.WHITE else chess.WHITE,
+        )
+    ]
+
+
+# FLIP_COLOR_INDICES[i] is the index of the piece type with the same type as PIECE_TYPES[i] but the other color
+FLIP_COLOR_INDICES = [_flip_color_index(i) for i in range(len(PIECE_TYPES))]
+
+
+def chess_board_to_tensor(board):
+    """Returns the one-hot tensor `[64, 13]` of `board`, or `[B, 64, 13]` if `board` is a list of boards."""
+    if not isinstance(board, chess.Board):
+        if len(board) == 0:
+            return torch.zeros(0, 64, len(PIECE_TYPES))
+        return torch.stack([chess_board_to_tensor(b) for b in board])
+
+    indices = [EMPTY_INDEX] * 64
+    for square, piece in board.piece_map().items():
+        indices[SQUARE_INDICES[square]] = PIECE_TYPE_INDICES[piece]
+
+    return torch.nn.functional.one_hot(
+        torch.tensor(indices), num_classes=len(PIECE_TYPES)
+    ).float()
+
+
+def to_one_hot(tensor: torch.Tensor):
+    """Replaces the scores of each square by a one-hot encoding of the most likely piece type.
+
+    The same as `chess_board_to_tensor(tensor_to_chess_board(tensor))`, but also for batches `[..., 64, 13]`.
+    """
+    return torch.nn.functional.one_hot(
+        tensor.argmax(dim=-1), num_classes=len(PIECE_TYPES)
+    ).to(tensor.dtype)
+
+
+def tensor_to_fen(tensor: torch.Tensor):
+    """Returns the FEN of the most likely piece on each square, without building a `chess.Board`.
+
+    The same as `tensor_to_chess_board(tensor).fen()`. For a batch `[B, 64, 13]` a list of FENs is returned.
+    """
+    if tensor.dim() == 3:
+        return [tensor_to_fen(t) for t in tensor]
+
+    symbols = [PIECE_SYMBOLS[i] for i in tensor.argmax(dim=-1).tolist()]
+    rows = ["".join(symbols[row * 8 : row * 8 + 8]) for row in range(8)]
+    placement = "/".join(rows)
+    placement = re.sub("1+", lambda match: str(len(match.group())), placement)
+
+    return placement + " w - - 0 1"
 
 
 def tensor_to_chess_board(tensor: torch.Tensor):
-    board = chess.Board(None)
+    """Returns the board with the most likely piece on each square. For a batch `[B, 64, 13]` a list of boards is returned."""
+    if tensor.dim() == 3:
+        return [tensor_to_chess_board(t) for t in tensor]
 
-    for square in chess.SQUARES:
-        index = tensor[square_to_idx(square)].argmax().item()
-        if PIECE_TYPES[index] is not None:
-            board.set_piece_at(square, PIECE_TYPES[index])
+    board = chess.Board(None)
+    board.set_piece_map(
+        {
+            IDX_SQUARES[idx]: PIECE_TYPES[index]
+            for idx, index in enumerate(tensor.argmax(dim=-1).tolist())
+            if index != EMPTY_INDEX
+        }
+    )
 
     return board
 
 
 def flip_color(tensor: torch.Tensor):
-    flipped = torch.zeros_like(tensor)
-
-    for square in chess.SQUARES:
-        sq_idx = square_to_idx(square)
-        for i, piece in enumerate(PIECE_TYPES):
-            if piece is None:
-                flipped[sq_idx, i] = tensor[sq_idx, i]
-            else:
-                other_piece_i = PIECE_TYPES.index(
-                    chess.Piece(
-                        piece.piece_type,
-                        chess.BLACK if piece.color == chess.WHITE else chess.WHITE,
-                    )
-                )
-                flipped[sq_idx, other_piece_i] = tensor[sq_idx, i]
-    return flipped
+    # Works for a single board [64, 13] as well as for batches of boards [..., 64, 13]
+    return tensor[..., FLIP_COLOR_INDICES]
 
 
 def rotate_board_tensor(tensor: torch.Tensor):
-    mirrored = torch.zeros_like(tensor)
-
-    for square in chess.SQUARES:
-        sq_idx = square_to_idx(square)
-        for i in range(0, len(PIECE_TYPES)):
-            mirrored_sq_idx = 7 - (sq_idx % 8) + (7 - (sq_idx // 8)) * 8
-            mirrored[mirrored_sq_idx, i] = tensor[sq_idx, i]
-    return mirrored
+    # Rotating by 180° maps the board tensor row idx to 63 - idx
+    return tensor.flip(-2)
 
 
 def get_image(board: chess.Board, width, height):
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import torch
+
+# Batch size of the example input the graph is traced with. The graph is checked for the other sizes in
+# CHECKED_BATCH_SIZES, so that one graph serves every batch size without padding.
+TRACE_BATCH_SIZE = 2
+CHECKED_BATCH_SIZES = (1, 10)
+
+
+def default_cache_dir() -> str:
+    return os.getenv(
+        "COMPILED_MODEL_DIR",
+        os.path.expanduser("~/.cache/chess_diagram_to_fen/compiled"),
+    )
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_code_digest(model: torch.nn.Module) -> str:
+    """Digest of the Python files of the package that defines the class of `model`, so that graphs which were
+    traced from an older version of the model code aren't loaded."""
+    directory = os.path.dirname(
+        os.path.abspath(sys.modules[type(model).__module__].__file__)
+    )
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".py"):
+            digest.update(name.encode())
+            digest.update(file_digest(os.path.join(directory, name)).encode())
+    return digest.hexdigest()
+
+
+class CompiledModel:
+    """Runs a model as a frozen TorchScript graph.
+
+    The graph is traced with `torch.jit.trace` (which drops the Python asserts and shape bookkeeping of `forward`)
+    and frozen with `torch.jit.freeze` (which folds the batch norms into the convolutions). The batch size stays
+    dynamic, which is checked against the model for the sizes `CHECKED_BATCH_SIZES`. If the graph doesn't give the
+    same outputs for them, the model runs eagerly. The graph is saved in `cache_dir`, under a name that depends on
+    the checkpoint, the model code, the input shape, the device and the PyTorch version, so that later processes
+    load it instead of tracing again.
+
+    Args:
+        - `model (torch.nn.Module)`: The loaded model, in eval mode on `device`.
+        - `input_shape (list)`: The shape of one input batch, e.g. `[1, 3, 256, 256]`. The batch size is ignored.
+        - `checkpoint_path (str)`: The checkpoint `model` was loaded from.
+        - `device (torch.device)`: The device of `model`.
+        - `cache_dir (str)`: Where the compiled graph is stored, by default `COMPILED_MODEL_DIR` or
+        `~/.cache/chess_diagram_to_fen/compiled`.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        input_shape: list,
+        checkpoint_path: str,
+        device: torch.device,
+        cache_dir=None,
+    ) -> None:
+        self.model = model
+        self.input_shape = list(input_shape[1:])
+        self.device = device
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        self.compiled = None
+        self.lock = threading.Lock()
+
+        digest = hashlib.sha256()
+        digest.update(file_digest(checkpoint_path).encode())
+        digest.update(model_code_digest(model).encode())
+        digest.update(f"{self.input_shape} {device.type} {torch.__version__}".encode())
+        self.prefix = (
+            os.path.splitext(os.path.basename(checkpoint_path))[0]
+            + "_"
+            + digest.hexdigest()[:16]
+        )
+
+    def artefact_path(self) -> str:
+        return os.path.join(self.cache_dir, f"{self.prefix}.pt")
+
+    def graph(self):
+        """Returns the compiled graph, from memory, from disk, or newly compiled. Returns the eager model if the
+        graph doesn't work for all batch sizes."""
+        with self.lock:
+            if self.compiled is None:
+                path = self.artefact_path()
+                if os.path.exists(path):
+                    self.compiled = torch.jit.load(path, map_location=self.device)
+                else:
+                    self.compiled = self.compile()
+                    if self.compiled is not self.model:
+                        self.save(self.compiled, path)
+                if self.compiled is not self.model:
+                    # The frozen graph has its own copy of the weights
+                    self.model = None
+            return self.compiled
+
+    @torch.no_grad()
+    def compile(self):
+        example_input = torch.rand(
+            [TRACE_BATCH_SIZE] + self.input_shape, device=self.device
+        )
+        traced = torch.jit.trace(self.model, example_input, check_trace=False)
+        graph = torch.jit.freeze(traced)
+
+        for batch_size in CHECKED_BATCH_SIZES:
+            input = torch.rand([batch_size] + self.input_shape, device=self.device)
+            try:
+                same = torch.allclose(graph(input), self.model(input), atol=1e-4)
+            except RuntimeError:
+                same = False
+            if not same:
+                print(
+                    f"WARNING: The graph of {type(self.model).__name__} doesn't work with a batch size of "
+                    f"{batch_size}, so it runs eagerly."
+                )
+                return self.model
+        return graph
+
+    def save(self, graph, path: str):
+        # Written to a temporary file first, so that other processes never load a partial file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(handle)
+        torch.jit.save(graph, tmp_path)
+        os.replace(tmp_path, path)
+
+    @torch.no_grad()
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        return self.graph()(input)
+
+    def eval(self):
+        return self
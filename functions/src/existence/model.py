@@ -7,11 +7,13 @@ from torchvision import models
 
 
 class ChessExistence(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
+        """`pretrained=False` skips loading the ImageNet weights of the backbone, e.g. when a checkpoint is loaded
+        afterwards anyway."""
         super(ChessExistence, self).__init__()
 
         self.model = models.regnet_x_800mf(
-            weights=models.RegNet_X_800MF_Weights.IMAGENET1K_V2
+            weights=models.RegNet_X_800MF_Weights.IMAGENET1K_V2 if pretrained else None
         )
         self.model.fc = torch.nn.LazyLinear(out_features=1)
 
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+
+
+class FenCache:
+    """Content-addressed cache for the results of the FEN pipeline.
+
+    Results are stored as JSON-serializable values under a key that is the digest of the decoded image
+    and the pipeline options (see `FenCache.key`). There are two tiers:
+    - an in-memory LRU tier, limited to `max_memory_bytes`, and
+    - an optional SQLite tier at `disk_path`, limited to `max_disk_bytes`, that survives restarts. When it
+    is full, the least recently used entries are evicted.
+
+    The cache is safe to use from multiple threads, and from multiple processes that share `disk_path`.
+    """
+
+    def __init__(
+        self, max_memory_bytes=16 * 2**20, disk_path=None, max_disk_bytes=256 * 2**20
+    ) -> None:
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_path = disk_path
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+        self.connection = None
+        self.connection_pid = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    @staticmethod
+    def from_env(default_disk_path=None):
+        """Creates a cache configured by the environment variables `FEN_CACHE_MAX_MB`, `FEN_CACHE_DISK_PATH` and
+        `FEN_CACHE_DISK_MAX_MB`. Returns `None` if `FEN_CACHE_MAX_MB` is `0`."""
+        max_memory_mb = float(os.getenv("FEN_CACHE_MAX_MB", "16"))
+        if max_memory_mb <= 0:
+            return None
+        return FenCache(
+            max_memory_bytes=int(max_memory_mb * 2**20),
+            disk_path=os.getenv("FEN_CACHE_DISK_PATH", default_disk_path) or None,
+            max_disk_bytes=int(
+                float(os.getenv("FEN_CACHE_DISK_MAX_MB", "256")) * 2**20
+            ),
+        )
+
+    @staticmethod
+    def key(img: Image.Image, options: dict) -> str:
+        """Digest of the decoded pixels of `img` and of the pipeline `options`."""
+        digest = hashlib.sha256()
+        digest.update(f"{img.mode} {img.width} {img.height}\n".encode())
+        digest.update(img.tobytes())
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """Returns `(True, value)` if `key` is cached, otherwise `(False, None)`."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return True, json.loads(self.memory[key])
+
+            if self.disk_path is not None:
+                row = (
+                    self._disk()
+                    .execute("SELECT value FROM fen_cache WHERE key = ?", (key,))
+                    .fetchone()
+                )
+                if row is not None:
+                    self._disk().execute(
+                        "UPDATE fen_cache SET last_access = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    self._disk().commit()
+                    self._put_memory(key, row[0])
+                    self.disk_hits += 1
+                    return True, json.loads(row[0])
+
+            self.misses += 1
+            return False, None
+
+    def put(self, key: str, value):
+        serialized = json.dumps(value)
+        with self.lock:
+            self._put_memory(key, serialized)
+
+            if self.disk_path is not None:
+                disk = self._disk()
+                size = len(key) + len(serialized)
+                # The total size is shared by all processes that use `disk_path`, so it is read and updated in the
+                # same write transaction as the entry
+                disk.execute("BEGIN IMMEDIATE")
+                try:
+                    old = disk.execute(
+                        "SELECT size FROM fen_cache WHERE key = ?", (key,)
+                    ).fetchone()
+                    disk.execute(
+                        "INSERT OR REPLACE INTO fen_cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                        (key, serialized, size, time.time()),
+                    )
+                    total = self._add_disk_total(
+                        size - (old[0] if old is not None else 0)
+                    )
+                    if total > self.max_disk_bytes:
+                        self._evict_disk(total)
+                    disk.commit()
+                except BaseException:
+                    disk.rollback()
+                    raise
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.memory_hits + self.disk_hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_evictions": self.memory_evictions,
+                "disk_evictions": self.disk_evictions,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+            }
+
+    def _put_memory(self, key: str, serialized: str):
+        if key in self.memory:
+            self.memory_bytes -= len(key) + len(self.memory.pop(key))
+        self.memory[key] = serialized
+        self.memory_bytes += len(key) + len(serialized)
+
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 0:
+            old_key, old_serialized = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_key) + len(old_serialized)
+            self.memory_evictions += 1
+
+    def _disk(self) -> sqlite3.Connection:
+        # A SQLite connection must not be shared with forked processes
+        if self.connection is None or self.connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.disk_path)), exist_ok=True)
+            self.connection = sqlite3.connect(
+                self.disk_path, check_same_thread=False, timeout=30
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fen_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS fen_cache_last_access ON fen_cache (last_access)"
+            )
+            # A single row with the total size of the entries, so that `put` doesn't have to sum them up
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fen_cache_total "
+                "(id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)"
+            )
+            if (
+                self.connection.execute("SELECT 1 FROM fen_cache_total").fetchone()
+                is None
+            ):
+                # A read lock can't be upgraded to a write lock while other processes write, so the sum is read
+                # in a write transaction
+                self.connection.execute("BEGIN IMMEDIATE")
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO fen_cache_total (id, bytes) "
+                    "SELECT 0, COALESCE(SUM(size), 0) FROM fen_cache"
+                )
+            self.connection.commit()
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def _add_disk_total(self, delta: int) -> int:
+        """Adds `delta` to the total size of the SQLite tier and returns the new total. Must be called within the
+        transaction that changes the entries."""
+        disk = self._disk()
+        disk.execute(
+            "UPDATE fen_cache_total SET bytes = bytes + ? WHERE id = 0", (delta,)
+        )
+        return disk.execute(
+            "SELECT bytes FROM fen_cache_total WHERE id = 0"
+        ).fetchone()[0]
+
+    def _evict_disk(self, total: int):
+        """Evicts the least recently used entries until the SQLite tier is at 90% of `max_disk_bytes`, so that the
+        next puts don't have to evict again. Must be called within the transaction of `put`.
+        """
+        disk = self._disk()
+        evicted = []
+        freed = 0
+        for key, size in disk.execute(
+            "SELECT key, size FROM fen_cache ORDER BY last_access ASC"
+        ):
+            if total - freed <= self.max_disk_bytes * 0.9:
+                break
+            evicted.append((key,))
+            freed += size
+
+        disk.executemany("DELETE FROM fen_cache WHERE key = ?", evicted)
+        self._add_disk_total(-freed)
+        self.disk_evictions += len(evicted)
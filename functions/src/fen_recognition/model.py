@@ -2,13 +2,16 @@ import torch
 import torch.nn as nn
 
 from src import consts, common
+from src.fen_recognition.tile_cache import TileEmbeddingCache, tile_keys
 
 from torchvision import models
 
 
-def get_tile_model():
+def get_tile_model(pretrained=True):
 
-    result = models.regnet_x_800mf(weights=models.RegNet_X_800MF_Weights.IMAGENET1K_V2)
+    result = models.regnet_x_800mf(
+        weights=models.RegNet_X_800MF_Weights.IMAGENET1K_V2 if pretrained else None
+    )
     result.fc = nn.Sequential(
         torch.nn.LazyLinear(out_features=512),
         nn.ReLU(),
@@ -19,9 +22,11 @@ def get_tile_model():
     return result
 
 
-def get_full_img_model():
+def get_full_img_model(pretrained=True):
 
-    result = models.regnet_x_800mf(weights=models.RegNet_X_800MF_Weights.IMAGENET1K_V2)
+    result = models.regnet_x_800mf(
+        weights=models.RegNet_X_800MF_Weights.IMAGENET1K_V2 if pretrained else None
+    )
     result.fc = nn.Sequential(
         torch.nn.LazyLinear(out_features=512),
         nn.ReLU(),
@@ -43,15 +48,67 @@ def get_dense_model():
 
 
 class ChessRec(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True, deduplicate_tiles=False, tile_cache_size=0):
+        """`pretrained=False` skips loading the ImageNet weights of the backbones, e.g. when a checkpoint is loaded
+        afterwards anyway.
+
+        In eval mode, `deduplicate_tiles=True` runs the tile encoder only once for pixel-identical squares, and
+        `tile_cache_size` (if greater than `0`) also keeps that many tile embeddings across calls, see
+        `encode_tiles`."""
         super(ChessRec, self).__init__()
 
-        self.tile = get_tile_model()
+        self.tile = get_tile_model(pretrained)
 
-        self.full = get_full_img_model()
+        self.full = get_full_img_model(pretrained)
 
         self.dense = get_dense_model()
 
+        self.deduplicate_tiles = deduplicate_tiles or tile_cache_size > 0
+        self.tile_cache = (
+            TileEmbeddingCache(tile_cache_size) if tile_cache_size > 0 else None
+        )
+
+    def encode_tiles(self, tiles):
+        """Runs the tile encoder on `tiles` `[N, 3, SQUARE_SIZE, SQUARE_SIZE]`.
+
+        With `deduplicate_tiles`, each distinct tile is encoded once and its embedding is copied to all positions of
+        that tile. This gives the same result because in eval mode every tile is encoded independently of the others
+        in the batch. While tracing or training, all tiles are encoded.
+        """
+        if (
+            not self.deduplicate_tiles
+            or self.training
+            or torch.jit.is_tracing()
+            or torch.jit.is_scripting()
+        ):
+            return self.tile(tiles)
+
+        keys = tile_keys(tiles)
+        unique = {}
+        first_indices = []
+        inverse = []
+        for i, key in enumerate(keys):
+            if key not in unique:
+                unique[key] = len(first_indices)
+                first_indices.append(i)
+            inverse.append(unique[key])
+        unique_keys = list(unique.keys())
+
+        embeddings = [None] * len(unique_keys)
+        if self.tile_cache is not None:
+            embeddings = self.tile_cache.get_many(unique_keys)
+
+        missing = [j for j, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            encoded = self.tile(tiles[[first_indices[j] for j in missing]])
+            for j, embedding in zip(missing, encoded):
+                embeddings[j] = embedding
+            if self.tile_cache is not None:
+                self.tile_cache.put_many([unique_keys[j] for j in missing], encoded)
+
+        inverse = torch.tensor(inverse, device=tiles.device)
+        return torch.stack(embeddings)[inverse]
+
     def forward(self, img):
         batch_size, ch, h, w = img.shape
 
@@ -75,7 +132,7 @@ class ChessRec(nn.Module):
 
         x = x.reshape(batch_size * 8 * 8, ch, consts.SQUARE_SIZE, consts.SQUARE_SIZE)
 
-        x = self.tile(x)
+        x = self.encode_tiles(x)
         assert len(x.shape) == 2, "Should be [batch_size, flattened]"
 
         x = x.reshape(batch_size, 64, -1)
@@ -0,0 +1,64 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+
+def tile_keys(tiles: torch.Tensor) -> list:
+    """Digest of the pixels of each tile in `tiles` `[N, ...]`."""
+    data = tiles.detach().reshape(len(tiles), -1).float().cpu().contiguous().numpy()
+    return [hashlib.blake2b(row.tobytes(), digest_size=16).digest() for row in data]
+
+
+class TileEmbeddingCache:
+    """LRU cache of the tile encoder outputs of `ChessRec`, keyed by the digest of the normalized tile (see
+    `tile_keys`). Printed and digital diagrams reuse the same empty squares and piece glyphs, across boards and
+    across requests. The cache belongs to one set of weights and is safe to use from multiple threads.
+
+    Args:
+        - `max_entries (int)`: The maximum number of embeddings. The least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_entries=4096) -> None:
+        self.max_entries = max_entries
+        self.embeddings = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, keys: list) -> list:
+        """Returns the cached embedding for each key in `keys`, or `None` if it isn't cached."""
+        results = []
+        with self.lock:
+            for key in keys:
+                embedding = self.embeddings.get(key)
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self.embeddings.move_to_end(key)
+                    self.hits += 1
+                results.append(embedding)
+        return results
+
+    def put_many(self, keys: list, embeddings: torch.Tensor):
+        # Copies of the rows, so that an entry doesn't keep the whole output batch alive
+        embeddings = [embedding.clone() for embedding in embeddings.detach()]
+        with self.lock:
+            for key, embedding in zip(keys, embeddings):
+                self.embeddings[key] = embedding
+                self.embeddings.move_to_end(key)
+
+            while len(self.embeddings) > self.max_entries:
+                self.embeddings.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.embeddings),
+            }
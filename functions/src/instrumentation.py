@@ -0,0 +1,59 @@
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+import torch
+
+# Functions that are called with `(stage name, seconds)` whenever a stage finishes, e.g. to record histograms
+observers = []
+
+# Per thread: the collectors of `collect`, and `annotate`, whether the stages are marked as ranges for
+# `torch.profiler` because this thread records a profile (see `src/profiling.py`)
+local = threading.local()
+
+
+@contextmanager
+def collect():
+    """Collects the total time of each stage (see `stage`) that runs in this thread within the block, as a dict
+    stage name -> seconds."""
+    if not hasattr(local, "collectors"):
+        local.collectors = []
+    timings = {}
+    local.collectors.append(timings)
+    try:
+        yield timings
+    finally:
+        # Collectors nest, and `remove` would compare the dicts by value
+        local.collectors.pop()
+
+
+@contextmanager
+def stage(name: str):
+    """Times the block as the pipeline stage `name`. Without collectors or observers, this only costs a lookup."""
+    collectors = getattr(local, "collectors", None)
+    if not collectors and len(observers) == 0 and not getattr(local, "annotate", False):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        with annotation(name):
+            yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def annotation(name: str):
+    """Marks the block as the range `name` in the trace while this thread records a profile, and does nothing
+    otherwise. Unlike `stage`, this isn't timed, so it can be used for parts of a stage.
+    """
+    if not getattr(local, "annotate", False):
+        return nullcontext()
+    return torch.profiler.record_function(name)
+
+
+def record(name: str, seconds: float):
+    """Records `seconds` for the stage `name`, for time that isn't measured by a block, e.g. a queue wait."""
+    for timings in getattr(local, "collectors", None) or []:
+        timings[name] = timings.get(name, 0.0) + seconds
+    for observer in observers:
+        observer(name, seconds)
@@ -0,0 +1,73 @@
+import os
+
+
+def process_memory(pid="self") -> dict:
+    """Returns the memory of the process `pid` in MB.
+
+    `rss` counts all resident pages, including the ones shared with other processes (e.g. model weights shared
+    copy-on-write with the parent), `pss` divides shared pages between the processes that share them, and `private`
+    is the memory only this process uses. The sum of the `pss` of a process tree is its actual memory use.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    except OSError:
+        # Without smaps_rollup (e.g. not Linux, or an old kernel), only the RSS is known
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    fields["Rss"] = int(line.split()[1]) / 1024
+
+    return {
+        "rss": fields.get("Rss", 0.0),
+        "pss": fields.get("Pss", fields.get("Rss", 0.0)),
+        "shared": fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+        "private": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+    }
+
+
+def child_pids(pid: int) -> list:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name in parentheses may contain spaces, the parent pid is the second field after it
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def format_memory(memory: dict) -> str:
+    return (
+        f"RSS {memory['rss']:7.1f} MB  PSS {memory['pss']:7.1f} MB  "
+        f"shared {memory['shared']:7.1f} MB  private {memory['private']:7.1f} MB"
+    )
+
+
+def memory_report(parent_pid: int) -> str:
+    """Memory of the process `parent_pid` and of each of its child processes (e.g. the server workers), and in total."""
+    lines = []
+    total_rss, total_pss = 0.0, 0.0
+    for label, pid in [("parent", parent_pid)] + [
+        ("worker", pid) for pid in child_pids(parent_pid)
+    ]:
+        try:
+            memory = process_memory(pid)
+        except OSError:
+            continue
+        total_rss += memory["rss"]
+        total_pss += memory["pss"]
+        lines.append(f"{label} {pid:>7}  {format_memory(memory)}")
+    lines.append(
+        f"total: PSS {total_pss:.1f} MB (sum of RSS {total_rss:.1f} MB counts shared pages repeatedly)"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,65 @@
+import os
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def export(model: torch.nn.Module, example_input: torch.Tensor, path: str, opset=17):
+    """Writes `model` to the ONNX file `path`, with a dynamic batch axis.
+
+    Args:
+        - `model (torch.nn.Module)`: The model in eval mode on the CPU. Its lazy layers must already be materialized.
+        - `example_input (torch.Tensor)`: An input for `model` that is used to trace it.
+        - `path (str)`: The ONNX file.
+        - `opset (int)`: The ONNX opset version.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (example_input,),
+            path,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+            opset_version=opset,
+            dynamo=False,
+        )
+
+
+class OnnxModel:
+    """Runs an exported model with ONNX Runtime on the CPU, as a drop-in replacement for the `torch.nn.Module`.
+
+    The number of threads can be set with the environment variables `ORT_INTRA_OP_THREADS` and
+    `ORT_INTER_OP_THREADS` (default `0`, i.e. chosen by ONNX Runtime).
+    """
+
+    def __init__(self, path: str) -> None:
+        if onnxruntime is None:
+            raise Exception(
+                "The ONNX backend needs onnxruntime. Install it with `pip install onnxruntime`."
+            )
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.intra_op_num_threads = int(os.getenv("ORT_INTRA_OP_THREADS", "0"))
+        options.inter_op_num_threads = int(os.getenv("ORT_INTER_OP_THREADS", "0"))
+
+        self.path = path
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        (output,) = self.session.run(
+            None, {"input": input.detach().cpu().float().numpy()}
+        )
+        return torch.from_numpy(output).to(input.device)
+
+    def eval(self):
+        return self
@@ -0,0 +1,65 @@
+import torch
+
+
+def cpu_flags() -> set:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def bf16_supported(device: torch.device) -> bool:
+    """Whether `device` computes in bfloat16 natively, i.e. faster than in float32."""
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    if not torch.backends.mkldnn.is_available():
+        return False
+
+    # Private API, so it may not exist in every version of PyTorch
+    is_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    if is_supported is not None and is_supported():
+        return True
+    return len({"avx512_bf16", "amx_bf16"} & cpu_flags()) > 0
+
+
+class MixedPrecisionModel:
+    """Runs a model with channels-last memory format and/or bfloat16 autocast, as a drop-in replacement for the
+    `torch.nn.Module`. Inputs and outputs stay float32, in the layout the caller expects.
+
+    Args:
+        - `model (torch.nn.Module)`: The loaded model on `device`.
+        - `device (torch.device)`: The device of `model`.
+        - `channels_last (bool)`: Whether to convert the weights and the image inputs to channels-last.
+        - `bf16 (bool)`: Whether to run under bfloat16 autocast. Callers should check `bf16_supported` first.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device: torch.device,
+        channels_last=True,
+        bf16=False,
+    ) -> None:
+        self.model = model
+        self.device = device
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        if self.channels_last and len(input.shape) == 4:
+            input = input.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(
+            device_type=self.device.type, dtype=torch.bfloat16, enabled=self.bf16
+        ):
+            output = self.model(input)
+        return output.float().contiguous()
+
+    def eval(self):
+        self.model.eval()
+        return self
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import torch
+
+from src import instrumentation
+
+# Only one profile is recorded at a time, the profiler is global to the process
+recording = threading.Lock()
+
+
+class RateLimit:
+    """Allows at most one profile per `min_interval_s` seconds. Recording a profile slows down everything else that
+    runs in the process, so a server must not profile every request that asks for it."""
+
+    def __init__(self, min_interval_s=60.0) -> None:
+        self.min_interval_s = min_interval_s
+        self.last = None
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            if self.last is not None and now - self.last < self.min_interval_s:
+                return False
+            self.last = now
+            return True
+
+
+def profile_name(prefix="profile") -> str:
+    """A file name for a new profile that is unique across processes, e.g. `profile-20240419-093124-123-4711`."""
+    milliseconds = int(time.time() * 1000) % 1000
+    return f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{milliseconds:03d}-{os.getpid()}"
+
+
+@contextmanager
+def profile(directory: str, name: str, row_limit=30):
+    """Records the operators that run within the block with `torch.profiler`. Afterwards, the Chrome trace is
+    written to `<directory>/<name>.json` (open it in chrome://tracing or https://ui.perfetto.dev), and the tables of
+    the operators with the most CPU time to `<directory>/<name>.txt`. The stages of the pipeline (see
+    `src/instrumentation.py`) that run on this thread are marked as ranges in the trace.
+
+    Yields a dict with the paths of the `trace` and the `table`, which exist once the block is done. Raises an
+    `Exception` if another profile is being recorded.
+    """
+    if not recording.acquire(blocking=False):
+        raise Exception("Another profile is being recorded")
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        paths = {
+            "trace": os.path.join(directory, name + ".json"),
+            "table": os.path.join(directory, name + ".txt"),
+        }
+
+        instrumentation.local.annotate = True
+        try:
+            with torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True
+            ) as profiler:
+                yield paths
+        finally:
+            instrumentation.local.annotate = False
+
+        profiler.export_chrome_trace(paths["trace"])
+        averages = profiler.key_averages()
+        with open(paths["table"], "w") as f:
+            f.write("Operators by self CPU time\n")
+            f.write(averages.table(sort_by="self_cpu_time_total", row_limit=row_limit))
+            f.write("\n\nOperators and stages by total CPU time\n")
+            f.write(averages.table(sort_by="cpu_time_total", row_limit=row_limit))
+    finally:
+        recording.release()
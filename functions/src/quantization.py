@@ -0,0 +1,63 @@
+import warnings
+import torch
+from torchvision import models
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# Backbones that are quantized statically (weights and activations), everything else is traced as it is
+STATIC_BACKBONES = (models.RegNet, models.segmentation.LRASPP)
+
+
+def backbones(model: torch.nn.Module):
+    """Yields `(parent, name, child)` for every backbone (or prepared backbone) of `model`."""
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, STATIC_BACKBONES + (torch.fx.GraphModule,)):
+                yield parent, name, child
+
+
+def prepare(model: torch.nn.Module, example_input: torch.Tensor):
+    """Prepares `model` for INT8 post-training quantization, in place.
+
+    The backbones are replaced by traced copies with observers, which record the ranges of the activations while
+    the model is run on calibration images. Afterwards, `convert` turns the model into the quantized model.
+
+    Args:
+        - `model (torch.nn.Module)`: The model in eval mode on the CPU.
+        - `example_input (torch.Tensor)`: An input for `model`, used to materialize lazy layers.
+    """
+    model.eval()
+    with torch.no_grad():
+        model(example_input)
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    for parent, name, child in backbones(model):
+        setattr(parent, name, prepare_fx(child, qconfig_mapping, (example_input,)))
+    return model
+
+
+def convert(model: torch.nn.Module):
+    """Turns a model that was prepared with `prepare` into the quantized model, in place.
+
+    The backbones get statically quantized weights and activations, the remaining `Linear` layers (e.g. the dense
+    heads) are quantized dynamically, i.e. their activations are quantized on the fly.
+    """
+    with warnings.catch_warnings():
+        # Observers that never saw data (when a quantized checkpoint is loaded afterwards) warn about it
+        warnings.filterwarnings("ignore", message=".*must run observer.*")
+        for parent, name, child in backbones(model):
+            setattr(parent, name, convert_fx(child))
+    quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def build(model: torch.nn.Module, example_input: torch.Tensor):
+    """Turns the (not yet loaded) `model` into a quantized model with the structure of a quantized checkpoint, so
+    that the state dict of the checkpoint can be loaded into it."""
+    model.eval()
+    with torch.no_grad():
+        model(example_input)
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            if tensor.is_floating_point():
+                tensor.zero_()
+    return convert(prepare(model, example_input))
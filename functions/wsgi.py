@@ -0,0 +1,22 @@
+"""WSGI entry point for serving with several worker processes, see `gunicorn.conf.py`.
+
+All models are loaded here, in the parent process, before the workers are forked. The workers then share the
+weights copy-on-write instead of loading their own copies.
+"""
+
+import gc
+import os
+import sys
+import functions_framework
+
+app = functions_framework.create_app(
+    target=os.getenv("FUNCTION_TARGET", "process_chess_image"),
+    source=os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+)
+
+# create_app loaded main.py as the module "main"
+sys.modules["main"].engine.warm_up()
+
+# The garbage collector ignores all objects that exist now, so that collections in the workers don't write to (and
+# thereby copy) the memory pages they share with the parent process
+gc.freeze()
@@ -1,9 +1,14 @@
 import os
+import argparse
 import base64
 import asyncio
 import aiohttp
 from pathlib import Path
 import json
+import csv
+import random
+import time
+from collections import Counter
 import chess
 import chess.pgn
 from concurrent.futures import ThreadPoolExecutor
@@ -18,31 +23,70 @@ API_URL = os.getenv(
 )  # Default to localhost if not set
 
 
-def encode_image_to_base64(image_path):
+def image_mime_type(image_path):
+    ext = image_path.suffix.lower()
+    return "image/jpeg" if ext in [".jpg", ".jpeg"] else f"image/{ext[1:]}"
+
+
+def encode_image_to_base64(image_path, image_data=None):
     """Convert an image file to base64 string with data URL format."""
-    with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        # Get the file extension and create appropriate mime type
-        ext = image_path.suffix.lower()
-        mime_type = f"image/jpeg" if ext in [".jpg", ".jpeg"] else f"image/{ext[1:]}"
-        return f"data:{mime_type};base64,{encoded_string}"
+    if image_data is None:
+        image_data = image_path.read_bytes()
+    encoded_string = base64.b64encode(image_data).decode("utf-8")
+    return f"data:{image_mime_type(image_path)};base64,{encoded_string}"
+
 
+def side_to_move_of(image_path):
+    """The side to move from the first letter of the file name (`w` or `b`), `w` by default."""
+    first = image_path.stem[0].lower()
+    return first if first in ["w", "b"] else "w"
 
-async def process_puzzle(session, image_path):
+
+def request_arguments(image_path, side_to_move, upload, image_data=None):
+    """Keyword arguments of `session.post` for the upload mode `upload`:
+    - `raw`: the image file as body, the side to move as query parameter (smallest and cheapest to encode),
+    - `multipart`: the image file as multipart upload, or
+    - `json`: the image as base64 data URL in a JSON body.
+
+    `image_data` are the bytes of the image, which are read from `image_path` if they aren't given.
+    """
+    if image_data is None:
+        image_data = image_path.read_bytes()
+    if upload == "raw":
+        return dict(
+            data=image_data,
+            params={"side": side_to_move},
+            headers={"Content-Type": image_mime_type(image_path)},
+        )
+    if upload == "multipart":
+        form = aiohttp.FormData()
+        form.add_field("side", side_to_move)
+        form.add_field(
+            "image",
+            image_data,
+            filename=image_path.name,
+            content_type=image_mime_type(image_path),
+        )
+        return dict(data=form)
+    return dict(
+        json={
+            "image": encode_image_to_base64(image_path, image_data),
+            "side": side_to_move,
+        },
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def process_puzzle(session, image_path, upload="raw"):
     """Process a single puzzle image through the API."""
     # Get filename without extension to determine side to move
     filename = image_path.stem
-    side_to_move = filename[0].lower() if filename[0].lower() in ["w", "b"] else "w"
-
-    # Prepare the request data
-    data = {"image": encode_image_to_base64(image_path), "side": side_to_move}
+    side_to_move = side_to_move_of(image_path)
 
     # Make the API request
     try:
         async with session.post(
-            API_URL,
-            json=data,
-            headers={"Content-Type": "application/json"},
+            API_URL, **request_arguments(image_path, side_to_move, upload)
         ) as response:
             if response.status == 200:
                 result = await response.json()
@@ -59,6 +103,297 @@ async def process_puzzle(session, image_path):
         return None
 
 
+def batch_form(image_paths):
+    """Multipart upload of `image_paths` for the batch endpoint. The file name is the id of each image."""
+    form = aiohttp.FormData()
+    for image_path in image_paths:
+        form.add_field(f"side.{image_path.name}", side_to_move_of(image_path))
+        form.add_field(
+            image_path.name,
+            image_path.read_bytes(),
+            filename=image_path.name,
+            content_type=image_mime_type(image_path),
+        )
+    return form
+
+
+async def process_puzzle_batch(session, image_paths, on_result):
+    """Sends `image_paths` in one request to the batch endpoint, and calls `on_result` for each position as soon
+    as the server has finished it."""
+    by_id = {image_path.name: image_path for image_path in image_paths}
+    try:
+        async with session.post(
+            API_URL.rstrip("/") + "/batch", data=batch_form(image_paths)
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                print(
+                    f"Error processing a batch of {len(image_paths)} images: {error_text}"
+                )
+                return
+
+            # One JSON line per image, in the order in which the server finishes them
+            async for line in response.content:
+                if line.strip() == b"":
+                    continue
+                result = json.loads(line)
+                image_path = by_id[result["id"]]
+                if "fen" in result:
+                    print(f"Successfully processed {image_path.name}")
+                    print(f"FEN: {result['fen']}")
+                    on_result({"fen": result["fen"], "player_name": image_path.stem})
+                else:
+                    print(f"Error processing {image_path.name}: {result['error']}")
+
+    except Exception as e:
+        print(
+            f"Exception while processing a batch of {len(image_paths)} images: {str(e)}"
+        )
+
+
+async def process_all_puzzles_batched(
+    image_paths, on_result, batch_size=32, max_concurrent=4
+):
+    """Process puzzles in batches of `batch_size` images per request, with up to `max_concurrent` requests at a
+    time."""
+    async with aiohttp.ClientSession() as session:
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        async def process_with_semaphore(batch):
+            async with semaphore:
+                await process_puzzle_batch(session, batch, on_result)
+
+        await asyncio.gather(
+            *[
+                process_with_semaphore(image_paths[i : i + batch_size])
+                for i in range(0, len(image_paths), batch_size)
+            ]
+        )
+
+
+def arrival_times(rps, duration, arrivals="poisson", seed=0):
+    """Start times in seconds of the requests of a load test with `rps` requests per second for `duration`
+    seconds. `poisson` arrivals have exponentially distributed gaps like independent users, `constant` ones are
+    evenly spaced."""
+    rng = random.Random(seed)
+    times, t = [], 0.0
+    while True:
+        t += rng.expovariate(rps) if arrivals == "poisson" else 1 / rps
+        if t >= duration:
+            return times
+        times.append(t)
+
+
+async def timed_request(session, image_path, image_data, upload, timeout, scheduled):
+    """Sends one request of a load test and returns a record of it. The latency is measured from the time the
+    request was scheduled, so that requests which the client could only send late still count their wait.
+    """
+    record = {
+        "image": image_path.name,
+        "lag_ms": (time.perf_counter() - scheduled) * 1000,
+        "status": None,
+        "error": None,
+    }
+    try:
+        async with session.post(
+            API_URL,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            **request_arguments(
+                image_path, side_to_move_of(image_path), upload, image_data
+            ),
+        ) as response:
+            body = await response.read()
+            record["status"] = response.status
+            if response.status == 200:
+                record["outcome"] = "ok"
+            else:
+                record["outcome"] = "error"
+                record["error"] = body.decode(errors="replace")[:200]
+    except asyncio.TimeoutError:
+        record["outcome"] = "timeout"
+    except Exception as e:
+        record["outcome"] = "error"
+        record["error"] = str(e) or type(e).__name__
+    record["latency_ms"] = (time.perf_counter() - scheduled) * 1000
+    return record
+
+
+async def run_load_test(
+    image_paths,
+    rps,
+    duration,
+    arrivals="poisson",
+    upload="raw",
+    timeout=30.0,
+    max_in_flight=1000,
+    seed=0,
+):
+    """Sends requests at the arrival times of `arrival_times`, independently of how fast the server answers
+    (open loop), and replays `image_paths` in order. A request that would exceed `max_in_flight` open requests
+    isn't sent and is recorded as `skipped`. Returns the records of all requests and the elapsed seconds.
+    """
+    # Read before the start, so that reading the files doesn't delay the requests
+    images = [(image_path, image_path.read_bytes()) for image_path in image_paths]
+    records, tasks, in_flight = [], [], set()
+    # No limit on the connections, the default pool would hold requests back like a closed loop
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0)
+    ) as session:
+        start = time.perf_counter()
+        for i, offset in enumerate(arrival_times(rps, duration, arrivals, seed)):
+            image_path, image_data = images[i % len(images)]
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if len(in_flight) >= max_in_flight:
+                records.append(
+                    {
+                        "image": image_path.name,
+                        "scheduled_s": offset,
+                        "outcome": "skipped",
+                    }
+                )
+                continue
+
+            task = asyncio.create_task(
+                timed_request(
+                    session, image_path, image_data, upload, timeout, start + offset
+                )
+            )
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            tasks.append((offset, task))
+
+        for offset, task in tasks:
+            records.append(dict(await task, scheduled_s=offset))
+        elapsed = time.perf_counter() - start
+
+    records.sort(key=lambda record: record["scheduled_s"])
+    return records, elapsed
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def latency_cdf(latencies, max_points=200):
+    """`(latency in ms, fraction of requests that were at least as fast)` pairs, at most `max_points` of them."""
+    latencies = sorted(latencies)
+    step = max(1, len(latencies) // max_points)
+    indices = list(range(step - 1, len(latencies), step))
+    if len(latencies) > 0 and indices[-1] != len(latencies) - 1:
+        indices.append(len(latencies) - 1)
+    return [(latencies[i], (i + 1) / len(latencies)) for i in indices]
+
+
+def summarize_load_test(records, elapsed, rps, duration):
+    """Counts of the outcomes and the latency percentiles of the successful requests of one load test. The
+    throughput is relative to the `duration` of the arrivals, because `elapsed` also includes waiting for the
+    last responses."""
+    outcomes = Counter(record["outcome"] for record in records)
+    latencies = [
+        record["latency_ms"] for record in records if record["outcome"] == "ok"
+    ]
+    summary = {
+        "target_rps": rps,
+        "duration_s": duration,
+        "elapsed_s": elapsed,
+        "requests": len(records),
+        "ok": outcomes["ok"],
+        "errors": outcomes["error"],
+        "timeouts": outcomes["timeout"],
+        "skipped": outcomes["skipped"],
+        "achieved_rps": outcomes["ok"] / duration if duration > 0 else 0.0,
+        "status_codes": dict(
+            Counter(str(record["status"]) for record in records if record.get("status"))
+        ),
+        "max_lag_ms": max([record.get("lag_ms", 0.0) for record in records] or [0.0]),
+    }
+    if len(latencies) > 0:
+        summary["latency_ms"] = {
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies),
+        }
+    return summary
+
+
+def print_load_test(summary, records):
+    print(
+        f"\n{summary['target_rps']:g} requests/s: {summary['requests']} requests in {summary['elapsed_s']:.1f} s, "
+        f"{summary['ok']} ok ({summary['achieved_rps']:.2f}/s), {summary['errors']} errors, "
+        f"{summary['timeouts']} timeouts, {summary['skipped']} skipped"
+    )
+    if summary["status_codes"]:
+        print(f"Status codes: {summary['status_codes']}")
+    if summary["max_lag_ms"] > 100:
+        print(
+            f"WARNING: Requests were sent up to {summary['max_lag_ms']:.0f} ms late, the client couldn't keep up"
+        )
+    if "latency_ms" not in summary:
+        return
+
+    latencies = [
+        record["latency_ms"] for record in records if record["outcome"] == "ok"
+    ]
+    print("Latency CDF of the successful requests:")
+    for p in [10, 25, 50, 75, 90, 95, 99, 99.9, 100]:
+        print(f"    {p:>5g}%  {percentile(latencies, p):>10.1f} ms")
+
+
+def write_load_test_report(path, runs):
+    """Writes the load tests `runs` (list of `(summary, records)`) to `path`: every request as a row if it ends with
+    `.csv`, otherwise the summaries, CDFs and requests as JSON."""
+    if path.endswith(".csv"):
+        fields = [
+            "target_rps",
+            "scheduled_s",
+            "image",
+            "outcome",
+            "status",
+            "latency_ms",
+            "lag_ms",
+            "error",
+        ]
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            for summary, records in runs:
+                for record in records:
+                    writer.writerow(dict(record, target_rps=summary["target_rps"]))
+        return
+
+    with open(path, "w") as f:
+        json.dump(
+            [
+                dict(
+                    summary,
+                    cdf=latency_cdf(
+                        [
+                            record["latency_ms"]
+                            for record in records
+                            if record["outcome"] == "ok"
+                        ]
+                    ),
+                    requests=records,
+                )
+                for summary, records in runs
+            ],
+            f,
+            indent=2,
+        )
+
+
+def write_pgn_game(pgn_file, game, index):
+    if index > 0:
+        print("\n", file=pgn_file)
+    print(game, file=pgn_file, end="\n\n")
+
+
 def create_pgn_game(fen_data):
     game = chess.pgn.Game()
 
@@ -76,7 +411,7 @@ def create_pgn_game(fen_data):
     return game
 
 
-async def process_all_puzzles(image_paths, max_concurrent=5):
+async def process_all_puzzles(image_paths, max_concurrent=5, upload="raw"):
     """Process multiple puzzles concurrently."""
     async with aiohttp.ClientSession() as session:
         tasks = []
@@ -85,7 +420,7 @@ async def process_all_puzzles(image_paths, max_concurrent=5):
 
         async def process_with_semaphore(image_path):
             async with semaphore:
-                return await process_puzzle(session, image_path)
+                return await process_puzzle(session, image_path, upload)
 
         # Create tasks for all images
         for image_path in image_paths:
@@ -98,6 +433,61 @@ async def process_all_puzzles(image_paths, max_concurrent=5):
 
 
 async def main():
+    parser = argparse.ArgumentParser(
+        description="Sends the images in puzzles/ to the API and writes the positions to puzzles.pgn"
+    )
+    parser.add_argument(
+        "--upload",
+        choices=["raw", "multipart", "json"],
+        default="raw",
+        help="how images are sent: raw image body, multipart upload, or base64 in JSON (default: raw)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=0,
+        help="send this many images per request to the batch endpoint, and write the positions as they arrive "
+        "(default: 0, one request per image)",
+    )
+    load_test = parser.add_argument_group(
+        "load test",
+        "send the images at a fixed rate, regardless of how fast they are answered, and report the latencies "
+        "instead of writing puzzles.pgn",
+    )
+    load_test.add_argument(
+        "--rps",
+        type=float,
+        nargs="+",
+        default=None,
+        help="requests per second; several rates are tested one after another",
+    )
+    load_test.add_argument(
+        "--duration", type=float, default=60.0, help="seconds per rate (default: 60)"
+    )
+    load_test.add_argument(
+        "--arrivals",
+        choices=["poisson", "constant"],
+        default="poisson",
+        help="random (poisson) or evenly spaced (constant) requests (default: poisson)",
+    )
+    load_test.add_argument(
+        "--timeout", type=float, default=30.0, help="seconds per request (default: 30)"
+    )
+    load_test.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=1000,
+        help="open requests at which further ones are skipped (default: 1000)",
+    )
+    load_test.add_argument("--seed", type=int, default=0)
+    load_test.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="write every request to this .csv file, or the summaries, CDFs and requests to this .json file",
+    )
+    args = parser.parse_args()
+
     # Get the puzzles directory path
     puzzles_dir = Path("puzzles")
 
@@ -117,10 +507,64 @@ async def main():
 
     print(f"Found {len(image_paths)} images to process")
 
+    if args.rps is not None:
+        image_paths.sort()
+        runs = []
+        for rps in args.rps:
+            records, elapsed = await run_load_test(
+                image_paths,
+                rps,
+                args.duration,
+                arrivals=args.arrivals,
+                upload=args.upload,
+                timeout=args.timeout,
+                max_in_flight=args.max_in_flight,
+                seed=args.seed,
+            )
+            summary = summarize_load_test(records, elapsed, rps, args.duration)
+            print_load_test(summary, records)
+            runs.append((summary, records))
+
+        if len(runs) > 1:
+            print(
+                f"\n{'requests/s':>10}{'ok/s':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'failed':>8}"
+            )
+            for summary, _ in runs:
+                latency = summary.get("latency_ms", {})
+                failed = summary["errors"] + summary["timeouts"] + summary["skipped"]
+                print(
+                    f"{summary['target_rps']:>10g}{summary['achieved_rps']:>8.2f}{latency.get('p50', float('nan')):>10.1f}"
+                    f"{latency.get('p95', float('nan')):>10.1f}{latency.get('p99', float('nan')):>10.1f}{failed:>8}"
+                )
+        if args.report is not None:
+            write_load_test_report(args.report, runs)
+            print(f"Report written to {args.report}")
+        return
+
+    output_file = "puzzles.pgn"
+    if args.batch > 0:
+        with open(output_file, "w") as pgn_file:
+            games = []
+
+            def on_result(result):
+                game = create_pgn_game(result)
+                write_pgn_game(pgn_file, game, len(games))
+                pgn_file.flush()
+                games.append(game)
+
+            await process_all_puzzles_batched(
+                image_paths, on_result, batch_size=args.batch
+            )
+
+        print(
+            f"\nSuccessfully processed {len(games)} puzzles. Output written to {output_file}"
+        )
+        return
+
     # Process all puzzles concurrently
     # Adjust max_concurrent based on your Cloud Run configuration
     results = await process_all_puzzles(
-        image_paths, max_concurrent=80
+        image_paths, max_concurrent=80, upload=args.upload
     )  # or whatever limit you set
 
     # Create PGN games from results
@@ -128,12 +572,9 @@ async def main():
 
     # Write all games to a single PGN file
     if games:
-        output_file = "puzzles.pgn"
         with open(output_file, "w") as pgn_file:
             for i, game in enumerate(games):
-                if i > 0:
-                    print("\n", file=pgn_file)
-                print(game, file=pgn_file, end="\n\n")
+                write_pgn_game(pgn_file, game, i)
 
         print(
             f"\nSuccessfully processed {len(games)} puzzles. Output written to {output_file}"